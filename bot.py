@@ -1,13 +1,32 @@
 import os
 import logging
+import asyncio
+import time
+from collections import Counter, OrderedDict, deque
 from aiogram import Bot, Dispatcher, types, executor
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice
+from aiogram.utils.exceptions import (TelegramAPIError, RetryAfter, BotBlocked, ChatNotFound, UserDeactivated,
+                                      MessageNotModified)
 import sqlite3
 import uuid
+import json
+import re
+import csv
+import io
+import tempfile
+import hashlib
+import secrets
 import datetime
+import threading
+import contextvars
+import gzip
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 # Настройка логгирования
 logging.basicConfig(level=logging.INFO)
@@ -16,17 +35,230 @@ logger = logging.getLogger(__name__)
 # Инициализация бота
 API_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 ADMIN_ID = os.getenv('ADMIN_TELEGRAM_ID')  # Ваш ID в Telegram
+# Пул администраторов для разбора диспутов (через запятую); по умолчанию - только ADMIN_ID
+ADMIN_IDS = [int(admin_id) for admin_id in os.getenv('ADMIN_TELEGRAM_IDS', ADMIN_ID or '').split(',')
+             if admin_id.strip()]
+# Назначение диспутов: least_loaded - администратору с наименьшим числом открытых, round_robin - по очереди
+DISPUTE_ASSIGNMENT = os.getenv('DISPUTE_ASSIGNMENT', 'least_loaded')
 PROVIDER_TOKEN = os.getenv('TELEGRAM_PAYMENTS_PROVIDER_TOKEN')  # Токен платежного провайдера
 
-bot = Bot(token=API_TOKEN)
+# Метрики (счетчики и суммарное время в секундах)
+METRICS = Counter()
+
+def metric_inc(name, value=1):
+    METRICS[name] += value
+
+def metric_observe(name, seconds):
+    METRICS[f'{name}_count'] += 1
+    METRICS[f'{name}_sum'] += seconds
+    if seconds > METRICS[f'{name}_max']:
+        METRICS[f'{name}_max'] = seconds
+
+# Планировщик обновлений: обновления разных чатов обрабатываются параллельно
+# ограниченным пулом воркеров, обновления одного чата - строго по очереди
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '16'))
+UPDATE_QUEUE_LIMIT = int(os.getenv('UPDATE_QUEUE_LIMIT', '1000'))
+
+def update_chat_key(update):
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    if update.pre_checkout_query:
+        return update.pre_checkout_query.from_user.id
+    if update.shipping_query:
+        return update.shipping_query.from_user.id
+    # Обновления без чата порядка не требуют
+    return ('update', update.update_id)
+
+class UpdateScheduler:
+    def __init__(self, handler, workers, queue_limit):
+        self.handler = handler
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.chats = {}  # ключ чата -> очередь (update, future, время постановки)
+        self.ready = asyncio.Queue()  # чаты, у которых есть работа и нет активного воркера
+        self.has_space = asyncio.Event()
+        self.queued = 0
+        self.incoming = 0  # получены из getUpdates, но еще не поставлены в очередь
+        self.context = None  # контекст диспетчера, от которого получает копию каждое обновление
+        self.tasks = []
+
+    async def submit(self, update):
+        if not self.tasks:
+            # Запоминаем контекст диспетчера (текущие Bot и Dispatcher), чтобы обновления наследовали его contextvars
+            self.context = contextvars.copy_context()
+            self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        
+        while self.queued >= self.queue_limit:
+            metric_inc('update_queue_full')
+            self.has_space.clear()
+            await self.has_space.wait()
+        
+        key = update_chat_key(update)
+        future = asyncio.get_event_loop().create_future()
+        pending = self.chats.get(key)
+        if pending is None:
+            pending = self.chats[key] = deque()
+            self.ready.put_nowait(key)
+        pending.append((update, future, time.monotonic()))
+        self.queued += 1
+        METRICS['update_queue_depth'] = self.queued
+        return future
+
+    async def wait_for_space(self):
+        """Ждет, пока в очереди освободится место, и возвращает, сколько обновлений можно запросить"""
+        while self.queued + self.incoming >= self.queue_limit:
+            metric_inc('update_queue_full')
+            self.has_space.clear()
+            await self.has_space.wait()
+        return self.queue_limit - self.queued - self.incoming
+
+    async def worker(self):
+        while True:
+            key = await self.ready.get()
+            pending = self.chats[key]
+            update, future, enqueued_at = pending.popleft()
+            self.queued -= 1
+            METRICS['update_queue_depth'] = self.queued
+            self.has_space.set()
+            
+            started = time.monotonic()
+            metric_observe('update_queue_wait_seconds', started - enqueued_at)
+            try:
+                # Каждое обновление - отдельная задача со своей копией контекста: aiogram кэширует
+                # в contextvars состояние FSM пользователя, и у общего контекста воркера оно протухло бы
+                result = await self.context.run(asyncio.create_task, self.handler(update))
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                metric_observe('update_processing_seconds', time.monotonic() - started)
+                # Следующее обновление этого чата встает в конец общей очереди
+                if pending:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.chats[key]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+async def acknowledge_duplicate_callback(callback_query):
+    try:
+        await callback_query.bot.answer_callback_query(callback_query.id)
+    except TelegramAPIError as e:
+        logger.debug("Не удалось ответить на повторное нажатие %s: %s", callback_query.id, e)
+
+class ChatOrderedDispatcher(Dispatcher):
+    def __init__(self, *args, workers=UPDATE_WORKERS, queue_limit=UPDATE_QUEUE_LIMIT, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.update_scheduler = UpdateScheduler(self.updates_handler.notify, workers, queue_limit)
+        # Нажатия, которые еще обрабатываются: (user_id, callback_data) -> future результата
+        self.callbacks_in_flight = {}
+
+    async def process_updates(self, updates, fast: bool = True):
+        futures = []
+        for update in updates:
+            key = None
+            if update.callback_query:
+                key = (update.callback_query.from_user.id, update.callback_query.data)
+                in_flight = self.callbacks_in_flight.get(key)
+                if in_flight is not None:
+                    # Повторное нажатие той же кнопки: сразу снимаем "часики" и ждем результат первого
+                    metric_inc('coalesced_callbacks')
+                    asyncio.ensure_future(acknowledge_duplicate_callback(update.callback_query))
+                    futures.append(in_flight)
+                    continue
+            
+            future = await self.update_scheduler.submit(update)
+            if key is not None:
+                self.callbacks_in_flight[key] = future
+                future.add_done_callback(lambda done, key=key: self.release_callback(key, done))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    def release_callback(self, key, future):
+        if self.callbacks_in_flight.get(key) is future:
+            del self.callbacks_in_flight[key]
+
+    async def _process_polling_updates(self, updates, fast: bool = True):
+        # Пачка дошла до планировщика - дальше ее учитывает self.update_scheduler.queued
+        self.update_scheduler.incoming -= len(updates)
+        return await super()._process_polling_updates(updates, fast)
+
+class PollingBot(Bot):
+    async def get_updates(self, offset=None, limit=None, timeout=None, allowed_updates=None):
+        # start_polling запускает обработку каждой пачки отдельной задачей и сразу просит следующую,
+        # поэтому ограничение очереди держим здесь: пока места нет, новые обновления не запрашиваем
+        scheduler = dp.update_scheduler
+        space = await scheduler.wait_for_space()
+        updates = await super().get_updates(offset, min(limit or 100, space), timeout, allowed_updates)
+        scheduler.incoming += len(updates)
+        return updates
+
+bot = PollingBot(token=API_TOKEN)
 storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
+dp = ChatOrderedDispatcher(bot, storage=storage)
+
+def is_admin(user_id):
+    return str(user_id) == str(ADMIN_ID) or int(user_id) in ADMIN_IDS
 
 # Инициализация базы данных
+def add_missing_column(cursor, table, column, definition):
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in (row[1] for row in cursor.fetchall()):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+CATEGORY_NAME_MAX_LENGTH = 40
+
+def normalize_category(name):
+    # Схлопываем пробелы, чтобы "Игры" и " игры " оказались одной категорией
+    name = ' '.join(name.split())[:CATEGORY_NAME_MAX_LENGTH]
+    return name, name.casefold()
+
+def get_or_create_category(cursor, name):
+    return resolve_category(cursor, name)[0]
+
+def resolve_category(cursor, name):
+    name, name_key = normalize_category(name)
+    if not name:
+        return None, None
+    cursor.execute('INSERT OR IGNORE INTO categories (name, name_key) VALUES (?, ?)', (name, name_key))
+    cursor.execute('SELECT category_id, name FROM categories WHERE name_key = ?', (name_key,))
+    return cursor.fetchone()
+
+ARCHIVE_DB_PATH = os.getenv('ARCHIVE_DB_PATH', 'craazydeals_archive.db')
+
+def enable_incremental_vacuum(cursor, schema):
+    cursor.execute(f'PRAGMA {schema}.auto_vacuum')
+    if cursor.fetchone()[0] != 2:
+        cursor.execute(f'PRAGMA {schema}.auto_vacuum = INCREMENTAL')
+        cursor.execute(f'VACUUM {schema}')
+
 def init_db():
     conn = sqlite3.connect('craazydeals.db')
     cursor = conn.cursor()
     
+    # Освободившиеся страницы возвращаются порциями через incremental_vacuum (см. обслуживание базы);
+    # для существующей базы режим включается однократным VACUUM
+    enable_incremental_vacuum(cursor, 'main')
+    
+    # WAL позволяет читать параллельно с записью
+    cursor.execute('PRAGMA journal_mode = WAL')
+    
     # Таблица пользователей
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -36,9 +268,13 @@ def init_db():
         rating REAL DEFAULT 5.0,
         deals_count INTEGER DEFAULT 0,
         registered_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        is_banned BOOLEAN DEFAULT FALSE
+        is_banned BOOLEAN DEFAULT FALSE,
+        rating_sum REAL DEFAULT 0,
+        rating_count INTEGER DEFAULT 0
     )
     ''')
+    add_missing_column(cursor, 'users', 'rating_sum', 'REAL DEFAULT 0')
+    add_missing_column(cursor, 'users', 'rating_count', 'INTEGER DEFAULT 0')
     
     # Таблица товаров
     cursor.execute('''
@@ -51,9 +287,118 @@ def init_db():
         category TEXT,
         created_at TEXT DEFAULT CURRENT_TIMESTAMP,
         is_active BOOLEAN DEFAULT TRUE,
-        FOREIGN KEY (seller_id) REFERENCES users (user_id)
+        category_id INTEGER,
+        auto_delivery BOOLEAN DEFAULT FALSE,
+        keys_available INTEGER DEFAULT 0,
+        stock INTEGER,
+        FOREIGN KEY (seller_id) REFERENCES users (user_id),
+        FOREIGN KEY (category_id) REFERENCES categories (category_id)
+    )
     ''')
     
+    # Справочник категорий; product_count поддерживается триггерами
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS categories (
+        category_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        name_key TEXT UNIQUE,
+        product_count INTEGER DEFAULT 0
+    )
+    ''')
+    add_missing_column(cursor, 'products', 'category_id', 'INTEGER REFERENCES categories (category_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_category_id ON products (category_id, is_active)')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_products_category_insert AFTER INSERT ON products
+    WHEN NEW.is_active AND NEW.category_id IS NOT NULL
+    BEGIN
+        UPDATE categories SET product_count = product_count + 1 WHERE category_id = NEW.category_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_products_category_update AFTER UPDATE OF is_active, category_id ON products
+    BEGIN
+        UPDATE categories SET product_count = product_count - 1 WHERE OLD.is_active AND category_id = OLD.category_id;
+        UPDATE categories SET product_count = product_count + 1 WHERE NEW.is_active AND category_id = NEW.category_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_products_category_delete AFTER DELETE ON products
+    WHEN OLD.is_active AND OLD.category_id IS NOT NULL
+    BEGIN
+        UPDATE categories SET product_count = product_count - 1 WHERE category_id = OLD.category_id;
+    END
+    ''')
+    
+    # Ключи цифровых товаров для автовыдачи; keys_available в products поддерживается триггерами
+    add_missing_column(cursor, 'products', 'auto_delivery', 'BOOLEAN DEFAULT FALSE')
+    add_missing_column(cursor, 'products', 'keys_available', 'INTEGER DEFAULT 0')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS product_keys (
+        key_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER,
+        key TEXT,
+        added_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        deal_id TEXT,
+        claimed_at TEXT,
+        FOREIGN KEY (product_id) REFERENCES products (product_id)
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_product_keys_free ON product_keys (product_id, key_id) WHERE deal_id IS NULL
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_product_keys_deal ON product_keys (deal_id)')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_product_keys_insert AFTER INSERT ON product_keys
+    WHEN NEW.deal_id IS NULL
+    BEGIN
+        UPDATE products SET keys_available = keys_available + 1, auto_delivery = TRUE
+        WHERE product_id = NEW.product_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_product_keys_claim AFTER UPDATE OF deal_id ON product_keys
+    WHEN OLD.deal_id IS NULL AND NEW.deal_id IS NOT NULL
+    BEGIN
+        UPDATE products SET keys_available = keys_available - 1 WHERE product_id = NEW.product_id;
+    END
+    ''')
+    
+    # Остаток товара: NULL - без ограничений; при нуле товар снимается с витрины,
+    # а счетчики категорий обновляет trg_products_category_update
+    add_missing_column(cursor, 'products', 'stock', 'INTEGER')
+    cursor.execute('UPDATE products SET stock = keys_available WHERE auto_delivery AND stock IS NULL')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_products_sold_out AFTER UPDATE OF stock ON products
+    WHEN NEW.stock <= 0 AND NEW.is_active
+    BEGIN
+        UPDATE products SET is_active = FALSE WHERE product_id = NEW.product_id;
+    END
+    ''')
+    # У товара с автовыдачей остаток - это число свободных ключей: ручной остаток при загрузке
+    # первых ключей заменяется, а не складывается с ними
+    cursor.execute('DROP TRIGGER IF EXISTS trg_product_keys_stock')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_products_keys_stock AFTER UPDATE OF keys_available ON products
+    WHEN NEW.auto_delivery AND NEW.stock IS NOT NEW.keys_available
+    BEGIN
+        UPDATE products SET stock = NEW.keys_available,
+                            is_active = CASE WHEN stock = 0 AND NEW.keys_available > 0 THEN TRUE ELSE is_active END
+        WHERE product_id = NEW.product_id;
+    END
+    ''')
+    cursor.execute('''
+    UPDATE products SET stock = keys_available
+    WHERE auto_delivery AND stock IS NOT NULL AND stock != keys_available
+    ''')
+    
+    # Переносим текстовые категории старых товаров в справочник (счетчики обновят триггеры)
+    cursor.execute('SELECT DISTINCT category FROM products WHERE category_id IS NULL AND category IS NOT NULL')
+    for (name,) in cursor.fetchall():
+        category_id = get_or_create_category(cursor, name)
+        if category_id:
+            cursor.execute('UPDATE products SET category_id = ? WHERE category_id IS NULL AND category = ?',
+                           (category_id, name))
+    
     # Таблица сделок
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS deals (
@@ -68,11 +413,54 @@ def init_db():
         admin_commission REAL,
         buyer_confirmed BOOLEAN DEFAULT FALSE,
         seller_confirmed BOOLEAN DEFAULT FALSE,
+        sent_at TEXT,
         FOREIGN KEY (buyer_id) REFERENCES users (user_id),
         FOREIGN KEY (seller_id) REFERENCES users (user_id),
         FOREIGN KEY (product_id) REFERENCES products (product_id)
     )
     ''')
+    # Срок на диспут у отправленной сделки отсчитывается от отправки; у старых сделок время
+    # отправки неизвестно, для них остается прежний отсчет от создания
+    add_missing_column(cursor, 'deals', 'sent_at', 'TEXT')
+    cursor.execute("UPDATE deals SET sent_at = created_at WHERE status = 'sent' AND sent_at IS NULL")
+    
+    # Отзывы покупателей: не больше одного на сделку; сумма и число оценок продавца
+    # хранятся в users и обновляются в той же транзакции, что и отзыв
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS reviews (
+        review_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        deal_id TEXT UNIQUE,
+        product_id INTEGER,
+        seller_id INTEGER,
+        buyer_id INTEGER,
+        rating INTEGER,
+        text TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (product_id) REFERENCES products (product_id),
+        FOREIGN KEY (seller_id) REFERENCES users (user_id),
+        FOREIGN KEY (buyer_id) REFERENCES users (user_id)
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reviews_product ON reviews (product_id, review_id)')
+    
+    # Очередь диспутов: у каждого открытого диспута есть ответственный администратор из ADMIN_IDS
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS disputes (
+        deal_id TEXT PRIMARY KEY,
+        opened_by INTEGER,
+        opened_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        assigned_to INTEGER,
+        status TEXT DEFAULT 'open',
+        resolved_at TEXT,
+        resolution TEXT,
+        FOREIGN KEY (deal_id) REFERENCES deals (deal_id)
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_disputes_status ON disputes (status, assigned_to)')
+    cursor.execute('''
+    INSERT OR IGNORE INTO disputes (deal_id, opened_at, assigned_to)
+    SELECT deal_id, created_at, ? FROM deals WHERE status = 'dispute'
+    ''', (ADMIN_IDS[0] if ADMIN_IDS else None,))
     
     # Таблица сообщений в диспутах
     cursor.execute('''
@@ -87,6 +475,238 @@ def init_db():
     )
     ''')
     
+    # Очередь исходящих уведомлений (transactional outbox)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS outbox (
+        outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        dedupe_key TEXT UNIQUE,
+        chat_id INTEGER,
+        text TEXT,
+        reply_markup TEXT,
+        parse_mode TEXT,
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL DEFAULT 0,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        sent_at TEXT
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (sent_at, next_attempt_at)')
+    
+    # Идемпотентность: обработанные обновления и зачисленные платежи
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS processed_updates (
+        update_id INTEGER PRIMARY KEY,
+        processed_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS payments (
+        charge_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        amount REAL,
+        payload TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_payload ON payments (payload)')
+    
+    # Выставленные счета на пополнение; в payload счета передается только короткий токен
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS pending_invoices (
+        token TEXT PRIMARY KEY,
+        user_id INTEGER,
+        amount INTEGER,
+        currency TEXT,
+        status TEXT DEFAULT 'pending',
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        paid_at TEXT,
+        charge_id TEXT,
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_invoices_status ON pending_invoices (status, created_at)')
+    
+    # Запросы на вывод средств: requested -> approved -> paid или requested -> rejected
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS withdrawals (
+        withdrawal_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount REAL,
+        details TEXT,
+        status TEXT DEFAULT 'requested',
+        batch_id TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        decided_at TEXT,
+        paid_at TEXT,
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON withdrawals (status, withdrawal_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_withdrawals_batch ON withdrawals (batch_id)')
+    
+    # Индексы для страниц просмотра
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_products_seller ON products (seller_id, is_active)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deals_buyer ON deals (buyer_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deals_seller ON deals (seller_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deals_status ON deals (status, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deals_sent ON deals (status, sent_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deals_settled ON deals (status, COALESCE(completed_at, created_at))')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dispute_messages_deal ON dispute_messages (deal_id, sent_at)')
+    
+    # Архив закрытых сделок и их диспутов в отдельной базе
+    conn.commit()
+    cursor.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DB_PATH,))
+    enable_incremental_vacuum(cursor, 'archive')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archive.deals (
+        deal_id TEXT PRIMARY KEY,
+        buyer_id INTEGER,
+        seller_id INTEGER,
+        product_id INTEGER,
+        amount REAL,
+        status TEXT,
+        created_at TEXT,
+        completed_at TEXT,
+        admin_commission REAL,
+        buyer_confirmed BOOLEAN,
+        seller_confirmed BOOLEAN,
+        archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archive.dispute_messages (
+        message_id INTEGER PRIMARY KEY,
+        deal_id TEXT,
+        user_id INTEGER,
+        message TEXT,
+        sent_at TEXT
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_deals_buyer ON deals (buyer_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_deals_seller ON deals (seller_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS archive.idx_archive_messages_deal ON dispute_messages (deal_id, sent_at)')
+    
+    # Статистика продавцов: итоги и дневные срезы обновляются триггерами при смене статуса сделки,
+    # поэтому /stats читает несколько строк вместо полного прохода по deals
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'seller_stats'")
+    backfill_stats = cursor.fetchone() is None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS seller_stats (
+        seller_id INTEGER PRIMARY KEY,
+        deals_count INTEGER DEFAULT 0,
+        sales_count INTEGER DEFAULT 0,
+        gross REAL DEFAULT 0,
+        commission REAL DEFAULT 0,
+        refunds_count INTEGER DEFAULT 0,
+        refunds_amount REAL DEFAULT 0,
+        disputes_count INTEGER DEFAULT 0
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS seller_daily_stats (
+        seller_id INTEGER,
+        day TEXT,
+        deals_count INTEGER DEFAULT 0,
+        sales_count INTEGER DEFAULT 0,
+        gross REAL DEFAULT 0,
+        commission REAL DEFAULT 0,
+        refunds_count INTEGER DEFAULT 0,
+        refunds_amount REAL DEFAULT 0,
+        disputes_count INTEGER DEFAULT 0,
+        PRIMARY KEY (seller_id, day)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_deals_stats_created AFTER INSERT ON deals
+    BEGIN
+        INSERT INTO seller_stats (seller_id, deals_count) VALUES (NEW.seller_id, 1)
+        ON CONFLICT (seller_id) DO UPDATE SET
+            deals_count = deals_count + 1;
+        INSERT INTO seller_daily_stats (seller_id, day, deals_count) VALUES (NEW.seller_id, date('now'), 1)
+        ON CONFLICT (seller_id, day) DO UPDATE SET
+            deals_count = deals_count + 1;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_deals_stats_completed AFTER UPDATE OF status ON deals
+    WHEN NEW.status = 'completed' AND OLD.status != 'completed'
+    BEGIN
+        INSERT INTO seller_stats (seller_id, sales_count, gross, commission) VALUES (NEW.seller_id, 1, NEW.amount, NEW.admin_commission)
+        ON CONFLICT (seller_id) DO UPDATE SET
+            sales_count = sales_count + 1, gross = gross + NEW.amount, commission = commission + NEW.admin_commission;
+        INSERT INTO seller_daily_stats (seller_id, day, sales_count, gross, commission) VALUES (NEW.seller_id, date('now'), 1, NEW.amount, NEW.admin_commission)
+        ON CONFLICT (seller_id, day) DO UPDATE SET
+            sales_count = sales_count + 1, gross = gross + NEW.amount, commission = commission + NEW.admin_commission;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_deals_stats_refunded AFTER UPDATE OF status ON deals
+    WHEN NEW.status = 'refunded' AND OLD.status != 'refunded'
+    BEGIN
+        INSERT INTO seller_stats (seller_id, refunds_count, refunds_amount) VALUES (NEW.seller_id, 1, NEW.amount)
+        ON CONFLICT (seller_id) DO UPDATE SET
+            refunds_count = refunds_count + 1, refunds_amount = refunds_amount + NEW.amount;
+        INSERT INTO seller_daily_stats (seller_id, day, refunds_count, refunds_amount) VALUES (NEW.seller_id, date('now'), 1, NEW.amount)
+        ON CONFLICT (seller_id, day) DO UPDATE SET
+            refunds_count = refunds_count + 1, refunds_amount = refunds_amount + NEW.amount;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_deals_stats_dispute AFTER UPDATE OF status ON deals
+    WHEN NEW.status = 'dispute' AND OLD.status != 'dispute'
+    BEGIN
+        INSERT INTO seller_stats (seller_id, disputes_count) VALUES (NEW.seller_id, 1)
+        ON CONFLICT (seller_id) DO UPDATE SET
+            disputes_count = disputes_count + 1;
+        INSERT INTO seller_daily_stats (seller_id, day, disputes_count) VALUES (NEW.seller_id, date('now'), 1)
+        ON CONFLICT (seller_id, day) DO UPDATE SET
+            disputes_count = disputes_count + 1;
+    END
+    ''')
+    
+    if backfill_stats:
+        # Первый запуск: однократно собираем статистику по уже существующим сделкам (с архивом)
+        cursor.execute('''
+        CREATE TEMP VIEW all_seller_deals AS
+        SELECT seller_id, status, amount, admin_commission, date(created_at) AS created_day,
+               date(COALESCE(completed_at, created_at)) AS settled_day FROM main.deals
+        UNION ALL
+        SELECT seller_id, status, amount, admin_commission, date(created_at) AS created_day,
+               date(COALESCE(completed_at, created_at)) AS settled_day FROM archive.deals
+        ''')
+        # Как и в триггерах: сделка попадает в день создания, продажа и возврат - в день расчета
+        cursor.execute('''
+        INSERT INTO seller_daily_stats (seller_id, day, deals_count, sales_count, gross, commission,
+                                        refunds_count, refunds_amount, disputes_count)
+        SELECT seller_id, day, SUM(deals_count), SUM(sales_count), TOTAL(gross), TOTAL(commission),
+               SUM(refunds_count), TOTAL(refunds_amount), SUM(disputes_count)
+        FROM (
+            SELECT seller_id, created_day AS day, 1 AS deals_count, 0 AS sales_count, 0 AS gross, 0 AS commission,
+                   0 AS refunds_count, 0 AS refunds_amount, status = 'dispute' AS disputes_count
+            FROM temp.all_seller_deals
+            UNION ALL
+            SELECT seller_id, settled_day, 0, status = 'completed',
+                   CASE WHEN status = 'completed' THEN amount ELSE 0 END,
+                   CASE WHEN status = 'completed' THEN admin_commission ELSE 0 END,
+                   status = 'refunded',
+                   CASE WHEN status = 'refunded' THEN amount ELSE 0 END,
+                   0
+            FROM temp.all_seller_deals
+            WHERE status IN ('completed', 'refunded')
+        )
+        GROUP BY seller_id, day
+        ''')
+        cursor.execute('''
+        INSERT INTO seller_stats (seller_id, deals_count, sales_count, gross, commission,
+                                  refunds_count, refunds_amount, disputes_count)
+        SELECT seller_id, SUM(deals_count), SUM(sales_count), TOTAL(gross), TOTAL(commission),
+               SUM(refunds_count), TOTAL(refunds_amount), SUM(disputes_count)
+        FROM seller_daily_stats
+        GROUP BY seller_id
+        ''')
+        cursor.execute('DROP VIEW temp.all_seller_deals')
+    
     conn.commit()
     conn.close()
 
@@ -98,106 +718,523 @@ class Form(StatesGroup):
     add_product_description = State()
     add_product_price = State()
     add_product_category = State()
+    add_product_keys = State()
+    product_stock = State()
+    import_products = State()
     top_up_amount = State()
     withdraw_amount = State()
+    withdraw_details = State()
     dispute_message = State()
+    review_text = State()
     admin_message = State()
 
 # Комиссия администратора
 ADMIN_COMMISSION = 0.08  # 8%
 
+# Единственный писатель: все изменения базы проходят через одну задачу, которая
+# забирает накопившиеся запросы из очереди и применяет их одной транзакцией (group commit)
+WRITER_GROUP_COMMIT_DELAY = float(os.getenv('WRITER_GROUP_COMMIT_DELAY', '0.002'))
+WRITER_MAX_BATCH = int(os.getenv('WRITER_MAX_BATCH', '500'))
+
+class DatabaseWriter:
+    def __init__(self, path):
+        self.path = path
+        self.queue = asyncio.Queue()
+        # Транзакции выполняются в отдельном потоке, чтобы fsync не блокировал event loop
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self.conn = None
+        self.task = None
+        self.after_commit = []
+
+    async def execute(self, func):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        future = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((func, future))
+        return await future
+
+    def call_after_commit(self, callback):
+        # Вызывается из транзакции; callback выполнится в event loop после коммита
+        if callback not in self.after_commit:
+            self.after_commit.append(callback)
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            # В WAL достаточно synchronous=NORMAL: коммит не делает fsync базы, только журнала
+            self.conn.execute('PRAGMA synchronous = NORMAL')
+            self.conn.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DB_PATH,))
+        return self.conn
+
+    async def connection(self):
+        # Соединение создается в потоке писателя
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.connect)
+
+    async def run_between_batches(self, func):
+        # func(conn) выполняется в потоке писателя вне транзакции - между пакетами записей
+        return await asyncio.get_event_loop().run_in_executor(self.executor, lambda: func(self.connect()))
+
+    def apply_batch(self, batch):
+        cursor = self.connect().cursor()
+        results = []
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for func, future in batch:
+                # Ошибка одного запроса откатывает только его изменения
+                cursor.execute('SAVEPOINT request')
+                try:
+                    result = func(cursor)
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO request')
+                    results.append((future, None, e))
+                else:
+                    results.append((future, result, None))
+                cursor.execute('RELEASE request')
+            cursor.execute('COMMIT')
+        except Exception:
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            raise
+        return results
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if batch[0] is None:
+                return
+            if WRITER_GROUP_COMMIT_DELAY > 0:
+                await asyncio.sleep(WRITER_GROUP_COMMIT_DELAY)
+            stop = False
+            while len(batch) < WRITER_MAX_BATCH and not self.queue.empty():
+                request = self.queue.get_nowait()
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+            
+            started = time.monotonic()
+            try:
+                results = await loop.run_in_executor(self.executor, self.apply_batch, batch)
+            except Exception as e:
+                logger.exception("Не удалось закоммитить пакет из %s изменений", len(batch))
+                self.after_commit.clear()
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                metric_observe('db_commit_seconds', time.monotonic() - started)
+            
+            metric_inc('db_write_batches')
+            metric_inc('db_writes', len(batch))
+            callbacks, self.after_commit = self.after_commit, []
+            for callback in callbacks:
+                callback()
+            for future, result, error in results:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            if stop:
+                return
+
+    async def close(self):
+        if self.task is not None:
+            # Дожидаемся, пока будут применены все уже поставленные изменения
+            self.queue.put_nowait(None)
+            await self.task
+            self.task = None
+        if self.conn is not None:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.conn.close)
+            self.conn = None
+
+db_writer = DatabaseWriter('craazydeals.db')
+
+# Пул соединений только для чтения: в режиме WAL читатели не ждут писателя,
+# каждое соединение закреплено за своим потоком
+READ_POOL_SIZE = int(os.getenv('READ_POOL_SIZE', '4'))
+
+class ReadPool:
+    def __init__(self, path, size):
+        self.uri = f'file:{path}?mode=ro'
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='db-reader')
+        self.connections = []
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+            conn.execute('PRAGMA query_only = ON')
+            conn.execute('ATTACH DATABASE ? AS archive', (f'file:{ARCHIVE_DB_PATH}?mode=ro',))
+            self.local.conn = conn
+            self.connections.append(conn)
+        return conn
+
+    def run(self, func):
+        cursor = self.connection().cursor()
+        try:
+            return func(cursor)
+        finally:
+            cursor.close()
+
+    async def execute(self, func):
+        started = time.monotonic()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, self.run, func)
+        finally:
+            metric_observe('db_read_seconds', time.monotonic() - started)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for conn in self.connections:
+            conn.close()
+        self.connections = []
+
+db_reader = ReadPool('craazydeals.db', READ_POOL_SIZE)
+
 # Вспомогательные функции
-def get_user(user_id):
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+async def get_user(user_id):
+    def query(cursor):
+        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+        return cursor.fetchone()
+    return await db_reader.execute(query)
 
-def create_user(user_id, username):
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)', (user_id, username))
-    conn.commit()
-    conn.close()
+def format_rating(user):
+    if not user or not user[8]:
+        return "Нет оценок"
+    return f"{user[7] / user[8]:.1f} ({user[8]} отз.)"
 
-def update_balance(user_id, amount):
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
-    conn.commit()
-    conn.close()
+async def create_user(user_id, username):
+    def apply(cursor):
+        cursor.execute('INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)', (user_id, username))
+    await db_writer.execute(apply)
 
-def add_product(seller_id, title, description, price, category):
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO products (seller_id, title, description, price, category) VALUES (?, ?, ?, ?, ?)',
-                   (seller_id, title, description, price, category))
-    product_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return product_id
+async def update_balance(user_id, amount):
+    def apply(cursor):
+        cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
+    await db_writer.execute(apply)
 
-def get_product(product_id):
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM products WHERE product_id = ?', (product_id,))
-    product = cursor.fetchone()
-    conn.close()
-    return product
+async def add_product(seller_id, title, description, price, category):
+    def apply(cursor):
+        category_id, name = resolve_category(cursor, category)
+        cursor.execute('''
+        INSERT INTO products (seller_id, title, description, price, category, category_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (seller_id, title, description, price, name, category_id))
+        return cursor.lastrowid
+    return await db_writer.execute(apply)
 
-def get_user_products(user_id):
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM products WHERE seller_id = ? AND is_active = TRUE', (user_id,))
-    products = cursor.fetchall()
-    conn.close()
-    return products
+async def import_products_chunk(seller_id, rows):
+    def apply(cursor):
+        categories = {}
+        values = []
+        for title, description, price, category, stock in rows:
+            name_key = normalize_category(category)[1]
+            if name_key not in categories:
+                categories[name_key] = resolve_category(cursor, category)
+            category_id, name = categories[name_key]
+            values.append((seller_id, title, description, price, name, category_id, stock))
+        cursor.executemany('''
+        INSERT INTO products (seller_id, title, description, price, category, category_id, stock)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', values)
+        return len(values)
+    return await db_writer.execute(apply)
+
+async def get_product(product_id):
+    def query(cursor):
+        cursor.execute('SELECT * FROM products WHERE product_id = ?', (product_id,))
+        return cursor.fetchone()
+    return await db_reader.execute(query)
 
-def create_deal(buyer_id, seller_id, product_id, amount):
+async def get_user_products(user_id):
+    def query(cursor):
+        cursor.execute('SELECT * FROM products WHERE seller_id = ? AND (is_active = TRUE OR stock = 0)', (user_id,))
+        return cursor.fetchall()
+    return await db_reader.execute(query)
+
+async def get_active_categories():
+    def query(cursor):
+        cursor.execute('SELECT category_id, name, product_count FROM categories WHERE product_count > 0 ORDER BY name')
+        return cursor.fetchall()
+    return await db_reader.execute(query)
+
+async def get_category(category_ref):
+    def query(cursor):
+        if category_ref.isdigit():
+            cursor.execute('SELECT category_id, name, product_count FROM categories WHERE category_id = ?',
+                           (int(category_ref),))
+        else:
+            # Старые кнопки вида category_<название>
+            cursor.execute('SELECT category_id, name, product_count FROM categories WHERE name_key = ?',
+                           (normalize_category(category_ref)[1],))
+        return cursor.fetchone()
+    return await db_reader.execute(query)
+
+async def get_category_products(category_id):
+    def query(cursor):
+        cursor.execute('''
+        SELECT p.product_id, p.title, p.price, u.username, p.stock
+        FROM products p
+        JOIN users u ON p.seller_id = u.user_id
+        WHERE p.category_id = ? AND p.is_active = TRUE
+        ''', (category_id,))
+        return cursor.fetchall()
+    return await db_reader.execute(query)
+
+async def create_deal(buyer_id, seller_id, product_id, amount):
+    """Возвращает deal_id, None при нехватке средств или False, если у товара с автовыдачей кончились ключи"""
     deal_id = str(uuid.uuid4())
     commission = amount * ADMIN_COMMISSION
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    INSERT INTO deals (deal_id, buyer_id, seller_id, product_id, amount, admin_commission)
-    VALUES (?, ?, ?, ?, ?, ?)
-    ''', (deal_id, buyer_id, seller_id, product_id, amount, commission))
-    conn.commit()
-    conn.close()
-    return deal_id
+    def apply(cursor):
+        cursor.execute('SELECT title, auto_delivery, stock, is_active FROM products WHERE product_id = ?',
+                       (product_id,))
+        title, auto_delivery, stock, is_active = cursor.fetchone()
+        if not is_active or (stock is not None and stock <= 0):
+            return False, None
+        key = None
+        if auto_delivery:
+            # Все записи идут через один поток писателя, поэтому найденный ключ никто не займет до UPDATE ниже
+            cursor.execute('''
+            SELECT key_id, key FROM product_keys WHERE product_id = ? AND deal_id IS NULL ORDER BY key_id LIMIT 1
+            ''', (product_id,))
+            key = cursor.fetchone()
+            if key is None:
+                return False, None
+        
+        # Замораживаем деньги у покупателя в той же транзакции, что и создание сделки
+        cursor.execute('UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?',
+                       (amount, buyer_id, amount))
+        if cursor.rowcount == 0:
+            return None, None
+        cursor.execute('''
+        INSERT INTO deals (deal_id, buyer_id, seller_id, product_id, amount, admin_commission)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (deal_id, buyer_id, seller_id, product_id, amount, commission))
+        if stock is not None:
+            # На нуле товар снимет с продажи trg_products_sold_out
+            cursor.execute('UPDATE products SET stock = stock - 1 WHERE product_id = ? AND stock > 0', (product_id,))
+        if key is None:
+            return deal_id, None
+        
+        # Автовыдача: ключ закрепляется за сделкой, а сделка сразу считается отправленной
+        cursor.execute('UPDATE product_keys SET deal_id = ?, claimed_at = CURRENT_TIMESTAMP WHERE key_id = ?',
+                       (deal_id, key[0]))
+        cursor.execute('''
+        UPDATE deals SET status = 'sent', seller_confirmed = TRUE, sent_at = CURRENT_TIMESTAMP WHERE deal_id = ?
+        ''', (deal_id,))
+        keyboard = InlineKeyboardMarkup()
+        keyboard.add(InlineKeyboardButton("✅ Подтвердить получение", callback_data=f"confirm_{deal_id}"))
+        keyboard.add(InlineKeyboardButton("⚠️ Открыть диспут", callback_data=f"dispute_{deal_id}"))
+        enqueue_notifications(cursor, [
+            notification(buyer_id, f"""🔑 Ваш товар: {title}
 
-def get_deal(deal_id):
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM deals WHERE deal_id = ?', (deal_id,))
-    deal = cursor.fetchone()
-    conn.close()
-    return deal
+{key[1]}
 
-def update_deal_status(deal_id, status):
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE deals SET status = ? WHERE deal_id = ?', (status, deal_id))
-    if status == 'completed':
-        cursor.execute('UPDATE deals SET completed_at = CURRENT_TIMESTAMP WHERE deal_id = ?', (deal_id,))
-    conn.commit()
-    conn.close()
+Проверьте ключ и подтвердите получение. Если ключ не работает, откройте диспут.""",
+                         reply_markup=keyboard, dedupe_key=f"{deal_id}:key:buyer"),
+        ])
+        return deal_id, 'sent'
+    created, status = await db_writer.execute(apply)
+    if created:
+        metric_inc('deals_auto_delivered' if status == 'sent' else 'deals_created')
+        deal_timeouts.schedule(deal_id, status or 'pending', time.time())
+    return created
 
-def confirm_deal_for_user(deal_id, user_type):
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
+async def add_product_keys(product_id, keys):
+    def apply(cursor):
+        cursor.executemany('INSERT INTO product_keys (product_id, key) VALUES (?, ?)',
+                           [(product_id, key) for key in keys])
+        cursor.execute('SELECT keys_available FROM products WHERE product_id = ?', (product_id,))
+        return cursor.fetchone()[0]
+    return await db_writer.execute(apply)
+
+async def get_deal(deal_id, include_archive=False):
+    def query(cursor):
+        cursor.execute('SELECT * FROM deals WHERE deal_id = ?', (deal_id,))
+        deal = cursor.fetchone()
+        if deal is None and include_archive:
+            cursor.execute(f'SELECT {DEAL_COLUMNS} FROM archive.deals WHERE deal_id = ?', (deal_id,))
+            deal = cursor.fetchone()
+        return deal
+    return await db_reader.execute(query)
+
+SELLER_STATS_COLUMNS = 'deals_count, sales_count, gross, commission, refunds_count, refunds_amount, disputes_count'
+SELLER_STATS_PERIOD_DAYS = 30
+
+async def get_seller_stats(seller_id):
+    """Итоги за все время, за последние SELLER_STATS_PERIOD_DAYS дней и за сегодня - только из сводных таблиц"""
+    def query(cursor):
+        cursor.execute(f'SELECT {SELLER_STATS_COLUMNS} FROM seller_stats WHERE seller_id = ?', (seller_id,))
+        total = cursor.fetchone()
+        cursor.execute('''
+        SELECT TOTAL(deals_count), TOTAL(sales_count), TOTAL(gross), TOTAL(commission),
+               TOTAL(refunds_count), TOTAL(refunds_amount), TOTAL(disputes_count)
+        FROM seller_daily_stats
+        WHERE seller_id = ? AND day > date('now', ?)
+        ''', (seller_id, f'-{SELLER_STATS_PERIOD_DAYS} days'))
+        period = cursor.fetchone()
+        cursor.execute(f'''
+        SELECT {SELLER_STATS_COLUMNS} FROM seller_daily_stats WHERE seller_id = ? AND day = date('now')
+        ''', (seller_id,))
+        today = cursor.fetchone()
+        return total, period, today
+    return await db_reader.execute(query)
+
+# Допустимые оценки отзыва в звездах
+REVIEW_STARS = range(1, 6)
+
+async def add_review(deal_id, buyer_id, rating, text=None):
+    """Возвращает True, если отзыв сохранен, False - если он уже был, и None, если отзыв оставить нельзя"""
+    if rating not in REVIEW_STARS:
+        return None
+    def apply(cursor):
+        cursor.execute('SELECT buyer_id, seller_id, product_id, status FROM deals WHERE deal_id = ?', (deal_id,))
+        deal = cursor.fetchone()
+        if deal is None:
+            cursor.execute('SELECT buyer_id, seller_id, product_id, status FROM archive.deals WHERE deal_id = ?',
+                           (deal_id,))
+            deal = cursor.fetchone()
+        if deal is None or deal[0] != buyer_id or deal[3] != 'completed':
+            return None
+        cursor.execute('''
+        INSERT OR IGNORE INTO reviews (deal_id, product_id, seller_id, buyer_id, rating, text)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (deal_id, deal[2], deal[1], buyer_id, rating, text))
+        if cursor.rowcount == 0:
+            return False
+        cursor.execute('''
+        UPDATE users SET rating_sum = rating_sum + ?, rating_count = rating_count + 1,
+                         rating = (rating_sum + ?) / (rating_count + 1)
+        WHERE user_id = ?
+        ''', (rating, rating, deal[1]))
+        return True
+    return await db_writer.execute(apply)
+
+async def has_review(deal_id):
+    def query(cursor):
+        cursor.execute('SELECT 1 FROM reviews WHERE deal_id = ?', (deal_id,))
+        return cursor.fetchone() is not None
+    return await db_reader.execute(query)
+
+async def get_product_reviews(product_id, before_id, limit):
+    def query(cursor):
+        cursor.execute('SELECT COUNT(*) FROM reviews WHERE product_id = ?', (product_id,))
+        count = cursor.fetchone()[0]
+        cursor.execute('''
+        SELECT r.review_id, u.username, r.rating, r.text, r.created_at
+        FROM reviews r
+        LEFT JOIN users u ON r.buyer_id = u.user_id
+        WHERE r.product_id = ? AND (? = 0 OR r.review_id < ?)
+        ORDER BY r.review_id DESC
+        LIMIT ?
+        ''', (product_id, before_id, before_id, limit))
+        return count, cursor.fetchall()
+    return await db_reader.execute(query)
+
+async def check_ratings(fix=False):
+    """Офлайн-проверка: пересчитывает рейтинги из reviews и сравнивает с накопленными суммами в users"""
+    def query(cursor):
+        cursor.execute('''
+        SELECT u.user_id, u.rating_sum, u.rating_count, TOTAL(r.rating), COUNT(r.review_id)
+        FROM users u
+        LEFT JOIN reviews r ON r.seller_id = u.user_id
+        GROUP BY u.user_id
+        HAVING u.rating_sum != TOTAL(r.rating) OR u.rating_count != COUNT(r.review_id)
+        ''')
+        return cursor.fetchall()
+    mismatches = await db_reader.execute(query)
+    if fix and mismatches:
+        def apply(cursor):
+            cursor.executemany('''
+            UPDATE users SET rating_sum = ?, rating_count = ?,
+                             rating = CASE WHEN ? > 0 THEN ? / ? ELSE rating END
+            WHERE user_id = ?
+            ''', [(total, count, count, total, count, user_id) for user_id, _, _, total, count in mismatches])
+        await db_writer.execute(apply)
+    return mismatches
+
+async def get_user_deals(user_id, limit=10):
+    def query(cursor):
+        # Сделки, где пользователь является покупателем или продавцом
+        cursor.execute('''
+        SELECT d.deal_id, d.status, d.amount, p.title, 
+               CASE WHEN d.buyer_id = ? THEN 'buyer' ELSE 'seller' END AS role,
+               CASE WHEN d.buyer_id = ? THEN u2.username ELSE u1.username END AS counterparty
+        FROM deals d
+        JOIN products p ON d.product_id = p.product_id
+        JOIN users u1 ON d.buyer_id = u1.user_id
+        JOIN users u2 ON d.seller_id = u2.user_id
+        WHERE d.buyer_id = ? OR d.seller_id = ?
+        ORDER BY d.created_at DESC
+        LIMIT ?
+        ''', (user_id, user_id, user_id, user_id, limit))
+        return cursor.fetchall()
+    return await db_reader.execute(query)
+
+async def update_deal_status(deal_id, status):
+    def apply(cursor):
+        cursor.execute('UPDATE deals SET status = ? WHERE deal_id = ?', (status, deal_id))
+        if status == 'completed':
+            cursor.execute('UPDATE deals SET completed_at = CURRENT_TIMESTAMP WHERE deal_id = ?', (deal_id,))
+    await db_writer.execute(apply)
+    if status not in ('pending', 'sent'):
+        deal_timeouts.cancel(deal_id)
+
+async def mark_deal_sent(deal_id, notifications=()):
+    """Возвращает False, если сделка уже не ожидает отправки (например, ее вернул таймаут)"""
+    def apply(cursor):
+        # Отправка товара считается подтверждением со стороны продавца
+        cursor.execute('''
+        UPDATE deals SET status = 'sent', seller_confirmed = TRUE, sent_at = CURRENT_TIMESTAMP
+        WHERE deal_id = ? AND status = 'pending'
+        ''', (deal_id,))
+        if cursor.rowcount == 0:
+            return False
+        enqueue_notifications(cursor, notifications)
+        return True
+    if not await db_writer.execute(apply):
+        return False
+    # Срок на диспут у покупателя идет с момента отправки
+    deal_timeouts.schedule(deal_id, 'sent', time.time())
+    return True
+
+async def confirm_deal_for_user(deal_id, user_type, notifications=()):
+    """Возвращает None, если сделка уже закрыта, иначе - завершилась ли она после подтверждения"""
+    completed = await db_writer.execute(
+        lambda cursor: apply_deal_confirmation(cursor, deal_id, user_type, notifications))
+    if completed:
+        deal_timeouts.cancel(deal_id)
+    return completed
+
+def apply_deal_confirmation(cursor, deal_id, user_type, notifications=()):
+    # Статус проверяется в самой транзакции: сделку мог уже закрыть таймаут или администратор
     if user_type == 'buyer':
-        cursor.execute('UPDATE deals SET buyer_confirmed = TRUE WHERE deal_id = ?', (deal_id,))
+        cursor.execute("UPDATE deals SET buyer_confirmed = TRUE WHERE deal_id = ? AND status IN ('pending', 'sent')",
+                       (deal_id,))
     else:
-        cursor.execute('UPDATE deals SET seller_confirmed = TRUE WHERE deal_id = ?', (deal_id,))
+        cursor.execute("UPDATE deals SET seller_confirmed = TRUE WHERE deal_id = ? AND status IN ('pending', 'sent')",
+                       (deal_id,))
+    if cursor.rowcount == 0:
+        return None
     
     # Проверяем, подтвердили ли обе стороны
     cursor.execute('SELECT buyer_confirmed, seller_confirmed FROM deals WHERE deal_id = ?', (deal_id,))
     buyer_confirmed, seller_confirmed = cursor.fetchone()
     
     if buyer_confirmed and seller_confirmed:
+        # Обновляем статус сделки; деньги распределяются только если переход действительно произошел
+        cursor.execute('''
+        UPDATE deals SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+        WHERE deal_id = ? AND status IN ('pending', 'sent')
+        ''', (deal_id,))
+        if cursor.rowcount == 0:
+            return None
+        
         # Завершаем сделку и распределяем деньги
         cursor.execute('SELECT amount, admin_commission, seller_id FROM deals WHERE deal_id = ?', (deal_id,))
         amount, commission, seller_id = cursor.fetchone()
@@ -209,9 +1246,6 @@ def confirm_deal_for_user(deal_id, user_type):
         # Комиссия администратору
         cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (commission, ADMIN_ID))
         
-        # Обновляем статус сделки
-        cursor.execute('UPDATE deals SET status = "completed" WHERE deal_id = ?', (deal_id,))
-        
         # Увеличиваем счетчик сделок у участников
         cursor.execute('''
         UPDATE users SET deals_count = deals_count + 1 
@@ -219,37 +1253,1359 @@ def confirm_deal_for_user(deal_id, user_type):
            OR user_id IN (SELECT seller_id FROM deals WHERE deal_id = ?)
         ''', (deal_id, deal_id))
     
-    conn.commit()
-    conn.close()
+    enqueue_notifications(cursor, notifications)
+    return buyer_confirmed and seller_confirmed
 
-def add_dispute_message(deal_id, user_id, message):
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO dispute_messages (deal_id, user_id, message) VALUES (?, ?, ?)', 
-                   (deal_id, user_id, message))
-    conn.commit()
-    conn.close()
+async def refund_deal(deal_id, notifications=()):
+    """Возвращает False, если сделка уже закрыта"""
+    applied, seconds = await db_writer.execute(lambda cursor: apply_refund(cursor, deal_id, notifications))
+    observe_dispute_resolution(seconds)
+    deal_timeouts.cancel(deal_id)
+    return applied
 
-def get_dispute_messages(deal_id):
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
+def apply_refund(cursor, deal_id, notifications=()):
+    """Возвращает (применен ли возврат, время решения диспута в секундах или None)"""
+    # Статус меняется первым и только для открытой сделки: иначе ее уже закрыл другой администратор или таймаут
     cursor.execute('''
-    SELECT dm.message_id, dm.user_id, u.username, dm.message, dm.sent_at 
-    FROM dispute_messages dm
-    JOIN users u ON dm.user_id = u.user_id
-    WHERE dm.deal_id = ?
-    ORDER BY dm.sent_at
+    UPDATE deals SET status = 'refunded', completed_at = CURRENT_TIMESTAMP
+    WHERE deal_id = ? AND status IN ('pending', 'sent', 'dispute')
     ''', (deal_id,))
-    messages = cursor.fetchall()
-    conn.close()
-    return messages
+    if cursor.rowcount == 0:
+        return False, None
+    cursor.execute('SELECT buyer_id, amount, product_id FROM deals WHERE deal_id = ?', (deal_id,))
+    buyer_id, amount, product_id = cursor.fetchone()
+    cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, buyer_id))
+    # Единица товара без автовыдачи возвращается в остаток (выданный ключ вернуть нельзя),
+    # распроданный товар снова появляется в продаже; снятый с продажи (stock IS NULL) не трогаем
+    cursor.execute('''
+    UPDATE products SET stock = stock + 1,
+                        is_active = CASE WHEN stock = 0 THEN TRUE ELSE is_active END
+    WHERE product_id = ? AND NOT auto_delivery AND stock IS NOT NULL
+    ''', (product_id,))
+    enqueue_notifications(cursor, notifications)
+    return True, close_dispute(cursor, deal_id, 'refunded')
+
+async def pay_deal_to_seller(deal_id, notifications=()):
+    """Возвращает False, если сделка уже закрыта"""
+    applied, seconds = await db_writer.execute(lambda cursor: apply_pay_seller(cursor, deal_id, notifications))
+    observe_dispute_resolution(seconds)
+    deal_timeouts.cancel(deal_id)
+    return applied
+
+def apply_pay_seller(cursor, deal_id, notifications=()):
+    """Возвращает (применена ли выплата, время решения диспута в секундах или None)"""
+    cursor.execute('''
+    UPDATE deals SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+    WHERE deal_id = ? AND status IN ('pending', 'sent', 'dispute')
+    ''', (deal_id,))
+    if cursor.rowcount == 0:
+        return False, None
+    cursor.execute('SELECT seller_id, amount, admin_commission FROM deals WHERE deal_id = ?', (deal_id,))
+    seller_id, amount, commission = cursor.fetchone()
+    cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount - commission, seller_id))
+    cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (commission, ADMIN_ID))
+    enqueue_notifications(cursor, notifications)
+    return True, close_dispute(cursor, deal_id, 'paid_seller')
+
+def resolution_notifications(deal_id, outcome, buyer_id, seller_id, amount, commission):
+    if outcome == 'refund':
+        return [
+            notification(buyer_id,
+                         f"""💰 По диспуту #{deal_id} администратор принял решение вернуть вам деньги.
+Сумма {amount}₽ возвращена на ваш баланс.""",
+                         dedupe_key=f"{deal_id}:refunded:buyer"),
+            notification(seller_id,
+                         f"""ℹ️ По диспуту #{deal_id} администратор принял решение вернуть деньги покупателю.""",
+                         dedupe_key=f"{deal_id}:refunded:seller"),
+        ]
+    return [
+        notification(buyer_id,
+                     f"""ℹ️ По диспуту #{deal_id} администратор принял решение передать деньги продавцу.""",
+                     dedupe_key=f"{deal_id}:paid:buyer"),
+        notification(seller_id,
+                     f"""💰 По диспуту #{deal_id} администратор принял решение передать вам деньги.
+Сумма {amount - commission}₽ зачислена на ваш баланс (за вычетом комиссии {commission}₽).""",
+                     dedupe_key=f"{deal_id}:paid:seller"),
+    ]
+
+async def resolve_deals(deal_refs, outcome):
+    """Закрывает сразу много диспутов одним решением (refund или pay) в одной транзакции.
+    deal_refs - полные id сделок в диспуте или их начала не короче 8 символов (как в /disputes).
+    Возвращает (решенные, пропущенные) сделки; уведомления уходят через outbox после коммита"""
+    def apply(cursor):
+        resolved = []
+        skipped = []
+        durations = []
+        for deal_ref in deal_refs:
+            # Начало id ищем диапазоном [deal_ref, следующая строка той же длины) по первичному ключу;
+            # +status не дает планировщику взять вместо него индекс по статусу.
+            # Только диспуты: сделки без диспута так закрывать нельзя
+            cursor.execute('''
+            SELECT deal_id, buyer_id, seller_id, amount, admin_commission FROM deals
+            WHERE deal_id >= ? AND deal_id < ? AND +status = 'dispute'
+            LIMIT 2
+            ''', (deal_ref, deal_ref[:-1] + chr(ord(deal_ref[-1]) + 1)))
+            rows = cursor.fetchall()
+            if len(rows) != 1:
+                # Сделка не найдена, не в диспуте или начало id неоднозначно
+                skipped.append(deal_ref)
+                continue
+            deal_id, buyer_id, seller_id, amount, commission = rows[0]
+            notifications = resolution_notifications(deal_id, outcome, buyer_id, seller_id, amount, commission)
+            if outcome == 'refund':
+                applied, seconds = apply_refund(cursor, deal_id, notifications)
+            else:
+                applied, seconds = apply_pay_seller(cursor, deal_id, notifications)
+            if not applied:
+                skipped.append(deal_ref)
+                continue
+            durations.append(seconds)
+            resolved.append((deal_id, amount))
+        return resolved, skipped, durations
+    resolved, skipped, durations = await db_writer.execute(apply)
+    for (deal_id, _), seconds in zip(resolved, durations):
+        observe_dispute_resolution(seconds)
+        deal_timeouts.cancel(deal_id)
+    metric_inc('deals_bulk_resolved', len(resolved))
+    return resolved, skipped
+
+def pick_dispute_admin(cursor):
+    if not ADMIN_IDS:
+        return None
+    if DISPUTE_ASSIGNMENT == 'round_robin':
+        cursor.execute('SELECT assigned_to FROM disputes ORDER BY rowid DESC LIMIT 1')
+        last = cursor.fetchone()
+        if last is None or last[0] not in ADMIN_IDS:
+            return ADMIN_IDS[0]
+        return ADMIN_IDS[(ADMIN_IDS.index(last[0]) + 1) % len(ADMIN_IDS)]
+    cursor.execute('''
+    SELECT assigned_to, COUNT(*) FROM disputes WHERE status = 'open' GROUP BY assigned_to
+    ''')
+    load = dict(cursor.fetchall())
+    return min(ADMIN_IDS, key=lambda admin_id: load.get(admin_id, 0))
+
+async def open_dispute(deal_id, opened_by, notifications_for):
+    """Переводит сделку в диспут и назначает администратора; notifications_for(admin_id) строит уведомления"""
+    def apply(cursor):
+        cursor.execute("UPDATE deals SET status = 'dispute' WHERE deal_id = ? AND status IN ('pending', 'sent')",
+                       (deal_id,))
+        if cursor.rowcount == 0:
+            return None
+        admin_id = pick_dispute_admin(cursor)
+        cursor.execute('INSERT OR REPLACE INTO disputes (deal_id, opened_by, assigned_to) VALUES (?, ?, ?)',
+                       (deal_id, opened_by, admin_id))
+        enqueue_notifications(cursor, notifications_for(admin_id))
+        return admin_id
+    admin_id = await db_writer.execute(apply)
+    if admin_id is not None:
+        metric_inc('disputes_opened')
+        deal_timeouts.cancel(deal_id)
+    return admin_id
+
+def close_dispute(cursor, deal_id, resolution):
+    """Закрывает открытый диспут по сделке и возвращает время до решения в секундах"""
+    cursor.execute('''
+    SELECT (julianday('now') - julianday(opened_at)) * 86400 FROM disputes WHERE deal_id = ? AND status = 'open'
+    ''', (deal_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    cursor.execute('''
+    UPDATE disputes SET status = 'resolved', resolved_at = CURRENT_TIMESTAMP, resolution = ? WHERE deal_id = ?
+    ''', (resolution, deal_id))
+    return row[0]
+
+def observe_dispute_resolution(seconds):
+    if seconds is not None:
+        metric_inc('disputes_resolved')
+        metric_observe('dispute_resolution_seconds', seconds)
+
+async def get_dispute(deal_id):
+    def query(cursor):
+        cursor.execute('SELECT deal_id, opened_by, opened_at, assigned_to, status FROM disputes WHERE deal_id = ?',
+                       (deal_id,))
+        return cursor.fetchone()
+    return await db_reader.execute(query)
+
+async def get_open_disputes(after_rowid, limit, assigned_to=None):
+    def query(cursor):
+        cursor.execute('''
+        SELECT assigned_to, COUNT(*) FROM disputes WHERE status = 'open' GROUP BY assigned_to
+        ''')
+        load = cursor.fetchall()
+        cursor.execute('''
+        SELECT d.rowid, d.deal_id, d.opened_at, d.assigned_to, deals.amount
+        FROM disputes d
+        JOIN deals ON deals.deal_id = d.deal_id
+        WHERE d.status = 'open' AND d.rowid > ? AND (? IS NULL OR d.assigned_to = ?)
+        ORDER BY d.rowid
+        LIMIT ?
+        ''', (after_rowid, assigned_to, assigned_to, limit))
+        return load, cursor.fetchall()
+    return await db_reader.execute(query)
+
+async def credit_payment(charge_id, user_id, amount, payload):
+    def apply(cursor):
+        # Уникальный charge_id гарантирует, что один платеж зачисляется ровно один раз
+        cursor.execute('INSERT OR IGNORE INTO payments (charge_id, user_id, amount, payload) VALUES (?, ?, ?, ?)',
+                       (charge_id, user_id, amount, payload))
+        if cursor.rowcount == 0:
+            return False
+        cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
+        return True
+    return await db_writer.execute(apply)
+
+async def create_invoice(user_id, amount, currency):
+    token = secrets.token_urlsafe(12)
+    def apply(cursor):
+        cursor.execute('INSERT INTO pending_invoices (token, user_id, amount, currency) VALUES (?, ?, ?, ?)',
+                       (token, user_id, amount, currency))
+    await db_writer.execute(apply)
+    return token
+
+async def get_invoice(token):
+    def query(cursor):
+        cursor.execute('SELECT token, user_id, amount, currency, status FROM pending_invoices WHERE token = ?',
+                       (token,))
+        return cursor.fetchone()
+    return await db_reader.execute(query)
+
+async def credit_invoice(charge_id, token):
+    def apply(cursor):
+        cursor.execute('SELECT user_id, amount FROM pending_invoices WHERE token = ?', (token,))
+        invoice = cursor.fetchone()
+        if not invoice:
+            return None
+        user_id, amount = invoice[0], invoice[1] / 100
+        cursor.execute('INSERT OR IGNORE INTO payments (charge_id, user_id, amount, payload) VALUES (?, ?, ?, ?)',
+                       (charge_id, user_id, amount, token))
+        if cursor.rowcount == 0:
+            return False
+        cursor.execute('UPDATE users SET balance = balance + ? WHERE user_id = ?', (amount, user_id))
+        cursor.execute('''
+        UPDATE pending_invoices SET status = 'paid', paid_at = CURRENT_TIMESTAMP, charge_id = ?
+        WHERE token = ?
+        ''', (charge_id, token))
+        return user_id, amount
+    return await db_writer.execute(apply)
+
+async def request_withdrawal(user_id, amount):
+    def apply(cursor):
+        cursor.execute('UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?',
+                       (amount, user_id, amount))
+        if cursor.rowcount == 0:
+            return None
+        cursor.execute('INSERT INTO withdrawals (user_id, amount) VALUES (?, ?)', (user_id, amount))
+        withdrawal_id = cursor.lastrowid
+        # Администратору - не больше одного напоминания в час, а не сообщение на каждый запрос
+        hour = datetime.datetime.utcnow().strftime('%Y%m%d%H')
+        enqueue_notifications(cursor, [
+            notification(ADMIN_ID, "💸 Есть новые запросы на вывод средств: /withdrawals",
+                         dedupe_key=f"withdrawals:{hour}"),
+        ])
+        return withdrawal_id
+    return await db_writer.execute(apply)
+
+async def set_withdrawal_details(withdrawal_id, user_id, details):
+    def apply(cursor):
+        cursor.execute('''
+        UPDATE withdrawals SET details = ?
+        WHERE withdrawal_id = ? AND user_id = ? AND status = 'requested'
+        ''', (details, withdrawal_id, user_id))
+    await db_writer.execute(apply)
+
+async def get_withdrawal_queue(after_id, limit):
+    def query(cursor):
+        cursor.execute("SELECT COUNT(*), TOTAL(amount) FROM withdrawals WHERE status = 'requested'")
+        totals = cursor.fetchone()
+        cursor.execute('''
+        SELECT w.withdrawal_id, w.user_id, u.username, w.amount, w.details, w.created_at
+        FROM withdrawals w
+        JOIN users u ON w.user_id = u.user_id
+        WHERE w.status = 'requested' AND w.withdrawal_id > ?
+        ORDER BY w.withdrawal_id
+        LIMIT ?
+        ''', (after_id, limit))
+        return totals, cursor.fetchall()
+    return await db_reader.execute(query)
+
+async def decide_withdrawals(first_id, last_id, approve):
+    batch_id = secrets.token_hex(4)
+    def apply(cursor):
+        cursor.execute('''
+        SELECT withdrawal_id, user_id, amount FROM withdrawals
+        WHERE status = 'requested' AND withdrawal_id BETWEEN ? AND ?
+        ''', (first_id, last_id))
+        rows = cursor.fetchall()
+        if not rows:
+            return 0, 0
+        ids = [(row[0],) for row in rows]
+        if approve:
+            cursor.executemany('''
+            UPDATE withdrawals SET status = 'approved', batch_id = ?, decided_at = CURRENT_TIMESTAMP
+            WHERE withdrawal_id = ?
+            ''', [(batch_id, withdrawal_id) for (withdrawal_id,) in ids])
+            enqueue_notifications(cursor, [
+                notification(user_id, f"✅ Запрос на вывод №{withdrawal_id} на {amount}₽ одобрен и будет выплачен.",
+                             dedupe_key=f"withdrawal:{withdrawal_id}:approved")
+                for withdrawal_id, user_id, amount in rows
+            ])
+        else:
+            cursor.executemany('''
+            UPDATE withdrawals SET status = 'rejected', decided_at = CURRENT_TIMESTAMP
+            WHERE withdrawal_id = ?
+            ''', ids)
+            # Возвращаем списанные суммы на балансы
+            cursor.executemany('UPDATE users SET balance = balance + ? WHERE user_id = ?',
+                               [(amount, user_id) for _, user_id, amount in rows])
+            enqueue_notifications(cursor, [
+                notification(user_id, f"""❌ Запрос на вывод №{withdrawal_id} отклонен.
+Сумма {amount}₽ возвращена на ваш баланс.""",
+                             dedupe_key=f"withdrawal:{withdrawal_id}:rejected")
+                for withdrawal_id, user_id, amount in rows
+            ])
+        return len(rows), sum(row[2] for row in rows)
+    count, total = await db_writer.execute(apply)
+    return batch_id, count, total
+
+async def mark_withdrawal_batch_paid(batch_id):
+    def apply(cursor):
+        cursor.execute("SELECT withdrawal_id, user_id, amount FROM withdrawals WHERE batch_id = ? AND status = 'approved'",
+                       (batch_id,))
+        rows = cursor.fetchall()
+        cursor.execute('''
+        UPDATE withdrawals SET status = 'paid', paid_at = CURRENT_TIMESTAMP
+        WHERE batch_id = ? AND status = 'approved'
+        ''', (batch_id,))
+        enqueue_notifications(cursor, [
+            notification(user_id, f"💸 Вывод №{withdrawal_id} на {amount}₽ выплачен.",
+                         dedupe_key=f"withdrawal:{withdrawal_id}:paid")
+            for withdrawal_id, user_id, amount in rows
+        ])
+        return len(rows)
+    return await db_writer.execute(apply)
+
+async def add_dispute_message(deal_id, user_id, message):
+    def apply(cursor):
+        cursor.execute('INSERT INTO dispute_messages (deal_id, user_id, message) VALUES (?, ?, ?)',
+                       (deal_id, user_id, message))
+    await db_writer.execute(apply)
+
+async def deactivate_product(product_id):
+    def apply(cursor):
+        # Удаленный товар не должен попадать в список распроданных (stock = 0) у продавца
+        cursor.execute('UPDATE products SET is_active = FALSE, stock = NULL WHERE product_id = ?', (product_id,))
+    await db_writer.execute(apply)
+
+async def set_product_stock(product_id, stock):
+    def apply(cursor):
+        # Пополнение распроданного товара возвращает его на витрину
+        cursor.execute('''
+        UPDATE products SET stock = :stock,
+                            is_active = CASE WHEN stock = 0 AND (:stock IS NULL OR :stock > 0) THEN TRUE
+                                             ELSE is_active END
+        WHERE product_id = :product_id
+        ''', {'stock': stock, 'product_id': product_id})
+    await db_writer.execute(apply)
+
+async def get_dispute_messages(deal_id, before_id=None, after_id=None, limit=None):
+    """Окно переписки по индексу (deal_id, sent_at): последние limit сообщений до before_id
+    или первые limit после after_id, начиная с ближайшего к курсору. Возвращает limit + 1 строк,
+    чтобы вызывающий знал, есть ли что-то дальше"""
+    limit = limit or DISPUTE_PAGE_SIZE
+    def query(cursor):
+        if after_id is not None:
+            cursor.execute('''
+            SELECT dm.message_id, dm.user_id, u.username, dm.message, dm.sent_at
+            FROM dispute_messages dm
+            JOIN users u ON dm.user_id = u.user_id
+            WHERE dm.deal_id = ?
+              AND (dm.sent_at, dm.message_id) > (SELECT sent_at, message_id FROM dispute_messages WHERE message_id = ?)
+            ORDER BY dm.sent_at, dm.message_id
+            LIMIT ?
+            ''', (deal_id, after_id, limit + 1))
+        else:
+            cursor.execute('''
+            SELECT dm.message_id, dm.user_id, u.username, dm.message, dm.sent_at
+            FROM dispute_messages dm
+            JOIN users u ON dm.user_id = u.user_id
+            WHERE dm.deal_id = ?
+              AND (? IS NULL OR (dm.sent_at, dm.message_id) <
+                                 (SELECT sent_at, message_id FROM dispute_messages WHERE message_id = ?))
+            ORDER BY dm.sent_at DESC, dm.message_id DESC
+            LIMIT ?
+            ''', (deal_id, before_id, before_id, limit + 1))
+        return cursor.fetchall()
+    return await db_reader.execute(query)
+
+# Выгрузка в CSV: строки читаются пачками через fetchmany и сразу пишутся во временный файл,
+# так что память не зависит от объема выгрузки
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', '1000'))
+
+def export_csv(cursor, query, params, header, compress=False):
+    output = tempfile.TemporaryFile()
+    stream = gzip.GzipFile(fileobj=output, mode='wb') if compress else output
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(header)
+    cursor.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            break
+        writer.writerows(rows)
+        metric_inc('export_rows', len(rows))
+    text.flush()
+    text.detach()
+    if compress:
+        stream.close()
+    output.seek(0)
+    return output
+
+async def export_withdrawal_batch(batch_id):
+    return await db_reader.execute(lambda cursor: export_csv(cursor, '''
+    SELECT w.withdrawal_id, w.user_id, u.username, w.amount, w.details, w.created_at, w.decided_at
+    FROM withdrawals w
+    JOIN users u ON w.user_id = u.user_id
+    WHERE w.batch_id = ?
+    ORDER BY w.withdrawal_id
+    ''', (batch_id,), ('withdrawal_id', 'user_id', 'username', 'amount', 'details', 'created_at', 'approved_at')))
+
+# Массовая загрузка товаров из CSV/JSON: файл разбирается построчно в отдельном потоке,
+# валидные строки вставляются пачками через executemany
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', '1000'))
+IMPORT_MAX_ROWS = int(os.getenv('IMPORT_MAX_ROWS', '100000'))
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # лимит Bot API на скачивание файлов
+IMPORT_MAX_ERRORS_SHOWN = 20
+PRODUCT_TITLE_MAX_LENGTH = 200
+PRODUCT_PRICE_MAX = 10000000
+
+def iter_import_rows(file, filename):
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    if not filename.lower().endswith(('.json', '.jsonl')):
+        for row in csv.DictReader(text):
+            yield row
+        return
+    
+    for line in text:
+        if not line.strip():
+            continue
+        if line.lstrip().startswith('['):
+            # Обычный JSON-массив построчно не разобрать - читаем целиком (размер файла ограничен)
+            for row in json.loads(line + text.read()):
+                yield row
+            return
+        # JSON Lines: один объект на строку
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+def validate_import_row(row):
+    if not isinstance(row, dict):
+        raise ValueError("строка не является объектом с полями title, description, price, category")
+    title = str(row.get('title') or '').strip()
+    if not title:
+        raise ValueError("не указано название")
+    if len(title) > PRODUCT_TITLE_MAX_LENGTH:
+        raise ValueError("слишком длинное название")
+    try:
+        price = float(str(row.get('price')).replace(',', '.'))
+    except ValueError:
+        raise ValueError("некорректная цена")
+    if not 0 < price <= PRODUCT_PRICE_MAX:
+        raise ValueError("цена должна быть больше нуля")
+    category = str(row.get('category') or '')
+    if not normalize_category(category)[0]:
+        raise ValueError("не указана категория")
+    stock = row.get('stock')
+    if stock in (None, ''):
+        stock = None
+    else:
+        try:
+            stock = int(stock)
+        except (TypeError, ValueError):
+            raise ValueError("некорректный остаток")
+        if stock <= 0:
+            raise ValueError("остаток должен быть больше нуля")
+    return title, str(row.get('description') or '').strip(), price, category, stock
+
+def take_import_chunk(rows, errors, state):
+    chunk = []
+    for row in rows:
+        state['row'] += 1
+        if state['row'] > IMPORT_MAX_ROWS:
+            errors.append((state['row'], f"превышен лимит в {IMPORT_MAX_ROWS} строк, остаток файла пропущен"))
+            return chunk, True
+        try:
+            chunk.append(validate_import_row(row))
+        except ValueError as e:
+            errors.append((state['row'], str(e)))
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            return chunk, False
+    return chunk, True
+
+async def import_products_file(seller_id, file, filename):
+    loop = asyncio.get_event_loop()
+    rows = iter_import_rows(file, filename)
+    errors = []
+    state = {'row': 0}
+    imported = 0
+    started = time.monotonic()
+    while True:
+        try:
+            chunk, done = await loop.run_in_executor(None, take_import_chunk, rows, errors, state)
+        except (UnicodeDecodeError, csv.Error, ValueError) as e:
+            errors.append((state['row'], f"файл не удалось разобрать: {e}"))
+            break
+        if chunk:
+            imported += await import_products_chunk(seller_id, chunk)
+        if done:
+            break
+    duration = time.monotonic() - started
+    metric_inc('imported_products', imported)
+    metric_observe('import_seconds', duration)
+    if duration > 0:
+        METRICS['import_rows_per_second_last'] = round(state['row'] / duration)
+    return imported, errors, duration
+
+# Transactional outbox: уведомления пишутся в таблицу outbox в той же транзакции,
+# что и изменение состояния, а отправляет их фоновый диспетчер
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '5'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+
+outbox_wakeup = asyncio.Event()
+
+def notification(chat_id, text, reply_markup=None, parse_mode=None, dedupe_key=None):
+    if reply_markup is not None and not isinstance(reply_markup, str):
+        reply_markup = reply_markup.as_json()
+    return (dedupe_key, chat_id, text, reply_markup, parse_mode)
+
+def enqueue_notifications(cursor, notifications):
+    if not notifications:
+        return
+    # INSERT OR IGNORE по dedupe_key - повторная постановка того же уведомления ничего не делает
+    cursor.executemany('''
+    INSERT OR IGNORE INTO outbox (dedupe_key, chat_id, text, reply_markup, parse_mode)
+    VALUES (?, ?, ?, ?, ?)
+    ''', notifications)
+    db_writer.call_after_commit(outbox_wakeup.set)
+
+async def fetch_outbox_batch(limit):
+    def query(cursor):
+        cursor.execute('''
+        SELECT outbox_id, chat_id, text, reply_markup, parse_mode, attempts
+        FROM outbox
+        WHERE sent_at IS NULL AND next_attempt_at <= ? AND attempts < ?
+        ORDER BY outbox_id
+        LIMIT ?
+        ''', (time.time(), OUTBOX_MAX_ATTEMPTS, limit))
+        return cursor.fetchall()
+    return await db_reader.execute(query)
+
+async def complete_outbox_batch(sent_ids, failed, dropped):
+    def apply(cursor):
+        cursor.executemany('UPDATE outbox SET sent_at = CURRENT_TIMESTAMP WHERE outbox_id = ?',
+                           [(outbox_id,) for outbox_id in sent_ids])
+        cursor.executemany('UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE outbox_id = ?',
+                           failed)
+        cursor.executemany('UPDATE outbox SET attempts = ? WHERE outbox_id = ?',
+                           [(OUTBOX_MAX_ATTEMPTS, outbox_id) for outbox_id in dropped])
+        # Отправленные уведомления храним сутки, дальше они не нужны
+        cursor.execute("DELETE FROM outbox WHERE sent_at < datetime('now', '-1 day')")
+    await db_writer.execute(apply)
+
+async def deliver_chat_notifications(rows, sent_ids, failed, dropped):
+    # Уведомления одному чату отправляем строго по порядку
+    for i, (outbox_id, chat_id, text, reply_markup, parse_mode, attempts) in enumerate(rows):
+        try:
+            await bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+        except RetryAfter as e:
+            retry_at = time.time() + e.timeout
+            failed.extend((retry_at, row[0]) for row in rows[i:])
+            metric_inc('outbox_retry_after')
+            return
+        except (BotBlocked, ChatNotFound, UserDeactivated) as e:
+            # Повторять бессмысленно - пользователь недоступен
+            logger.info("Уведомление %s не доставлено: %s", outbox_id, e)
+            dropped.append(outbox_id)
+            metric_inc('outbox_undeliverable')
+            continue
+        except TelegramAPIError as e:
+            logger.warning("Ошибка отправки уведомления %s: %s", outbox_id, e)
+            # Экспоненциальная задержка перед следующей попыткой
+            retry_at = time.time() + min(2 ** attempts, 600)
+            failed.extend((retry_at, row[0]) for row in rows[i:])
+            metric_inc('outbox_failed')
+            return
+        sent_ids.append(outbox_id)
+
+async def run_outbox_dispatcher():
+    while True:
+        try:
+            rows = await fetch_outbox_batch(OUTBOX_BATCH_SIZE)
+            if not rows:
+                outbox_wakeup.clear()
+                try:
+                    await asyncio.wait_for(outbox_wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            by_chat = {}
+            for row in rows:
+                by_chat.setdefault(row[1], []).append(row)
+            
+            sent_ids, failed, dropped = [], [], []
+            started = time.monotonic()
+            await asyncio.gather(*(deliver_chat_notifications(chat_rows, sent_ids, failed, dropped)
+                                   for chat_rows in by_chat.values()))
+            await complete_outbox_batch(sent_ids, failed, dropped)
+            metric_inc('outbox_sent', len(sent_ids))
+            metric_observe('outbox_batch_seconds', time.monotonic() - started)
+            
+            if failed and not sent_ids:
+                await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Сбой диспетчера уведомлений")
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+# Таймауты сделок: сделка без отправки возвращает деньги покупателю через N часов,
+# отправленная сделка без диспута завершается в пользу продавца через M дней.
+# Таймеры хранятся в иерархическом колесе (timing wheel) и восстанавливаются при старте
+DEAL_PENDING_TIMEOUT = float(os.getenv('DEAL_PENDING_TIMEOUT_HOURS', '24')) * 3600
+DEAL_SENT_TIMEOUT = float(os.getenv('DEAL_SENT_TIMEOUT_DAYS', '3')) * 86400
+DEAL_TIMEOUT_TICK = float(os.getenv('DEAL_TIMEOUT_TICK', '60'))
+
+def parse_db_timestamp(value):
+    # CURRENT_TIMESTAMP в SQLite - это UTC в формате 'YYYY-MM-DD HH:MM:SS'
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S').replace(tzinfo=datetime.timezone.utc).timestamp()
+
+class TimingWheel:
+    def __init__(self, tick, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.timers = {}  # ключ -> (уровень, слот)
+        self.current = int(time.time() // tick)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        self.place(key, max(int(-(-deadline // self.tick)), self.current + 1))
+
+    def place(self, key, expires):
+        delta = expires - self.current
+        level, span = 0, self.slots
+        while delta >= span and level < self.levels - 1:
+            level += 1
+            span *= self.slots
+        slot = (expires // self.slots ** level) % self.slots
+        self.wheels[level][slot][key] = expires
+        self.timers[key] = (level, slot)
+
+    def cancel(self, key):
+        position = self.timers.pop(key, None)
+        if position:
+            level, slot = position
+            del self.wheels[level][slot][key]
+
+    def advance(self, now):
+        expired = []
+        target = int(now // self.tick)
+        while self.current < target:
+            self.current += 1
+            # Когда младшее колесо делает оборот, раскладываем слот старшего уровня вниз
+            for level in range(self.levels - 1, 0, -1):
+                if self.current % self.slots ** level == 0:
+                    slot = (self.current // self.slots ** level) % self.slots
+                    bucket, self.wheels[level][slot] = self.wheels[level][slot], {}
+                    for key, expires in bucket.items():
+                        self.place(key, expires)
+            bucket, self.wheels[0][self.current % self.slots] = self.wheels[0][self.current % self.slots], {}
+            for key, expires in bucket.items():
+                if expires <= self.current:
+                    del self.timers[key]
+                    expired.append(key)
+                else:
+                    self.place(key, expires)
+        return expired
+
+def apply_deal_timeout(cursor, deal_id):
+    cursor.execute('SELECT status, buyer_id, seller_id, amount, admin_commission FROM deals WHERE deal_id = ?',
+                   (deal_id,))
+    deal = cursor.fetchone()
+    if not deal:
+        return None
+    status, buyer_id, seller_id, amount, commission = deal
+    if status == 'pending':
+        apply_refund(cursor, deal_id, [
+            notification(buyer_id,
+                         f"""⌛ Продавец не отправил товар по сделке #{deal_id} вовремя.
+Сумма {amount}₽ возвращена на ваш баланс.""",
+                         dedupe_key=f"{deal_id}:timeout:buyer"),
+            notification(seller_id,
+                         f"⌛ Сделка #{deal_id} отменена: товар не был отправлен вовремя.",
+                         dedupe_key=f"{deal_id}:timeout:seller"),
+        ])
+        return 'refunded'
+    if status == 'sent':
+        apply_deal_confirmation(cursor, deal_id, 'buyer', [
+            notification(buyer_id,
+                         f"⌛ Сделка #{deal_id} автоматически завершена: срок для открытия диспута истек.",
+                         dedupe_key=f"{deal_id}:timeout:buyer"),
+            notification(seller_id,
+                         f"""⌛ Сделка #{deal_id} автоматически завершена.
+Ваш заработок: {amount - commission}₽ (за вычетом комиссии)""",
+                         dedupe_key=f"{deal_id}:timeout:seller"),
+        ])
+        return 'completed'
+    # Диспут или уже закрытая сделка - таймаут не применяется
+    return None
+
+class DealTimeouts:
+    def __init__(self, tick):
+        self.wheel = TimingWheel(tick)
+
+    def schedule(self, deal_id, status, started_at):
+        # started_at - время создания для ожидающей сделки и время отправки для отправленной
+        timeout = DEAL_PENDING_TIMEOUT if status == 'pending' else DEAL_SENT_TIMEOUT
+        self.wheel.schedule(deal_id, started_at + timeout)
+        METRICS['deal_timers'] = len(self.wheel)
+
+    def cancel(self, deal_id):
+        self.wheel.cancel(deal_id)
+        METRICS['deal_timers'] = len(self.wheel)
+
+    async def load(self):
+        def query(cursor):
+            # Оба запроса ищут по индексу, начинающемуся со status (idx_deals_status / idx_deals_sent)
+            cursor.execute('''
+            SELECT deal_id, status, created_at FROM deals WHERE status = 'pending'
+            UNION ALL
+            SELECT deal_id, status, COALESCE(sent_at, created_at) FROM deals WHERE status = 'sent'
+            ''')
+            return cursor.fetchall()
+        for deal_id, status, started_at in await db_reader.execute(query):
+            self.schedule(deal_id, status, parse_db_timestamp(started_at))
+        logger.info("Восстановлено таймеров сделок: %s", len(self.wheel))
+
+    async def run(self):
+        await self.load()
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            for deal_id in self.wheel.advance(time.time()):
+                try:
+                    outcome = await db_writer.execute(lambda cursor: apply_deal_timeout(cursor, deal_id))
+                except Exception:
+                    logger.exception("Не удалось применить таймаут сделки %s", deal_id)
+                    continue
+                if outcome:
+                    metric_inc(f'deal_timeouts_{outcome}')
+            METRICS['deal_timers'] = len(self.wheel)
+
+deal_timeouts = DealTimeouts(DEAL_TIMEOUT_TICK)
+
+# Архивация: сделки, закрытые больше ARCHIVE_AFTER_DAYS дней назад, вместе с сообщениями диспутов
+# переносятся в архивную базу небольшими транзакциями, чтобы горячие таблицы оставались маленькими
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '500'))
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', '3600'))
+
+DEAL_COLUMNS = '''deal_id, buyer_id, seller_id, product_id, amount, status, created_at, completed_at,
+                  admin_commission, buyer_confirmed, seller_confirmed'''
+
+def apply_archive_batch(cursor, cutoff, limit):
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS archive_batch (deal_id TEXT PRIMARY KEY)')
+    cursor.execute('DELETE FROM temp.archive_batch')
+    # Возраст считается от закрытия сделки (у старых возвратов без completed_at - от создания);
+    # использует индекс idx_deals_settled
+    cursor.execute('''
+    INSERT INTO temp.archive_batch (deal_id)
+    SELECT deal_id FROM deals
+    WHERE status IN ('completed', 'refunded') AND COALESCE(completed_at, created_at) < ?
+    LIMIT ?
+    ''', (cutoff, limit))
+    moved = cursor.rowcount
+    if not moved:
+        return 0, 0
+    
+    cursor.execute(f'''
+    INSERT OR REPLACE INTO archive.deals ({DEAL_COLUMNS})
+    SELECT {DEAL_COLUMNS} FROM deals WHERE deal_id IN (SELECT deal_id FROM temp.archive_batch)
+    ''')
+    cursor.execute('''
+    INSERT OR REPLACE INTO archive.dispute_messages (message_id, deal_id, user_id, message, sent_at)
+    SELECT message_id, deal_id, user_id, message, sent_at FROM dispute_messages
+    WHERE deal_id IN (SELECT deal_id FROM temp.archive_batch)
+    ''')
+    messages = cursor.rowcount
+    cursor.execute('DELETE FROM dispute_messages WHERE deal_id IN (SELECT deal_id FROM temp.archive_batch)')
+    cursor.execute('DELETE FROM deals WHERE deal_id IN (SELECT deal_id FROM temp.archive_batch)')
+    return moved, messages
+
+async def archive_settled_deals():
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    total_deals = total_messages = 0
+    while True:
+        started = time.monotonic()
+        deals, messages = await db_writer.execute(lambda cursor: apply_archive_batch(cursor, cutoff, ARCHIVE_BATCH_SIZE))
+        metric_observe('archive_batch_seconds', time.monotonic() - started)
+        total_deals += deals
+        total_messages += messages
+        if deals < ARCHIVE_BATCH_SIZE:
+            break
+        # Даем другим писателям пройти между пачками
+        await asyncio.sleep(0)
+    metric_inc('archived_deals', total_deals)
+    metric_inc('archived_dispute_messages', total_messages)
+    if total_deals:
+        logger.info("В архив перенесено сделок: %s, сообщений: %s", total_deals, total_messages)
+    return total_deals
+
+async def run_archiver():
+    while True:
+        try:
+            await archive_settled_deals()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Сбой архивации сделок")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+# Выгрузки для администратора: /export deals|ledger|balances [с] [по] [статус]
+EXPORT_FILTERS = '''
+WHERE (:date_from IS NULL OR {at} >= :date_from)
+  AND (:date_to IS NULL OR {at} < date(:date_to, '+1 day'))
+  AND (:status IS NULL OR {status} = :status)
+'''
+
+ALL_DEALS = f'''
+SELECT {DEAL_COLUMNS} FROM deals
+UNION ALL
+SELECT {DEAL_COLUMNS} FROM archive.deals
+'''
+
+# Движения денег восстанавливаются из первичных записей: платежей, сделок и выводов
+LEDGER = f'''
+WITH all_deals AS ({ALL_DEALS}),
+ledger (at, user_id, kind, amount, reference) AS (
+    SELECT created_at, user_id, 'topup', amount, charge_id FROM payments
+    UNION ALL
+    SELECT created_at, buyer_id, 'purchase', -amount, deal_id FROM all_deals
+    UNION ALL
+    SELECT COALESCE(completed_at, created_at), buyer_id, 'refund', amount, deal_id
+    FROM all_deals WHERE status = 'refunded'
+    UNION ALL
+    SELECT completed_at, seller_id, 'sale', amount - admin_commission, deal_id
+    FROM all_deals WHERE status = 'completed'
+    UNION ALL
+    SELECT completed_at, :admin_id, 'commission', admin_commission, deal_id
+    FROM all_deals WHERE status = 'completed'
+    UNION ALL
+    SELECT created_at, user_id, 'withdrawal', -amount, withdrawal_id FROM withdrawals
+    UNION ALL
+    SELECT decided_at, user_id, 'withdrawal_rejected', amount, withdrawal_id
+    FROM withdrawals WHERE status = 'rejected'
+)
+SELECT at, user_id, kind, amount, reference FROM ledger
+'''
+
+EXPORTS = {
+    'deals': (
+        f'SELECT * FROM ({ALL_DEALS})' + EXPORT_FILTERS.format(at='created_at', status='status') +
+        'ORDER BY created_at',
+        tuple(column.strip() for column in DEAL_COLUMNS.split(',')),
+    ),
+    'ledger': (
+        f'SELECT * FROM ({LEDGER})' + EXPORT_FILTERS.format(at='at', status='kind') + 'ORDER BY at',
+        ('at', 'user_id', 'kind', 'amount', 'reference'),
+    ),
+    'balances': (
+        '''SELECT user_id, username, balance, rating, deals_count, registered_at, is_banned FROM users''' +
+        EXPORT_FILTERS.format(at='registered_at',
+                              status="CASE WHEN is_banned THEN 'banned' ELSE 'active' END") +
+        'ORDER BY user_id',
+        ('user_id', 'username', 'balance', 'rating', 'deals_count', 'registered_at', 'is_banned'),
+    ),
+}
+
+async def export_report(kind, date_from=None, date_to=None, status=None):
+    query, header = EXPORTS[kind]
+    params = {'date_from': date_from, 'date_to': date_to, 'status': status, 'admin_id': ADMIN_ID}
+    started = time.monotonic()
+    output = await db_reader.execute(lambda cursor: export_csv(cursor, query, params, header, compress=True))
+    metric_observe('export_seconds', time.monotonic() - started)
+    return output
+
+# Онлайн-бэкапы через SQLite backup API: копирование идет маленькими шагами с паузами,
+# источник - соединение писателя, поэтому его изменения попадают в копию без перезапуска бэкапа
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = float(os.getenv('BACKUP_INTERVAL_HOURS', '24')) * 3600
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+BACKUP_PAGES_PER_STEP = int(os.getenv('BACKUP_PAGES_PER_STEP', '64'))
+BACKUP_STEP_SLEEP = float(os.getenv('BACKUP_STEP_SLEEP', '0.05'))
+
+backup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-backup')
+
+def backup_database(source, name, prefix):
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+    raw_path = os.path.join(BACKUP_DIR, f'{prefix}-{stamp}.db')
+    
+    # Длительность шага = время, на которое бэкап занимает соединение писателя
+    steps = []
+    last = [time.monotonic()]
+    def progress(status, remaining, total):
+        now = time.monotonic()
+        steps.append(now - last[0])
+        last[0] = now + BACKUP_STEP_SLEEP
+    
+    started = time.monotonic()
+    target = sqlite3.connect(raw_path)
+    try:
+        source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=progress, name=name, sleep=BACKUP_STEP_SLEEP)
+        result = target.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        target.close()
+    if result != 'ok':
+        os.remove(raw_path)
+        raise RuntimeError(f"Бэкап {raw_path} не прошел проверку целостности: {result}")
+    
+    with open(raw_path, 'rb') as raw, gzip.open(raw_path + '.gz', 'wb') as compressed:
+        shutil.copyfileobj(raw, compressed)
+    os.remove(raw_path)
+    
+    # Ротация: оставляем BACKUP_KEEP последних снимков
+    snapshots = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith(prefix + '-') and f.endswith('.db.gz'))
+    for old in snapshots[:-BACKUP_KEEP]:
+        os.remove(os.path.join(BACKUP_DIR, old))
+    
+    return raw_path + '.gz', time.monotonic() - started, max(steps, default=0), len(steps)
+
+async def run_backup():
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    source = await db_writer.connection()
+    loop = asyncio.get_event_loop()
+    paths = []
+    for name, prefix in (('main', 'craazydeals'), ('archive', 'craazydeals_archive')):
+        path, duration, max_step, steps = await loop.run_in_executor(
+            backup_executor, backup_database, source, name, prefix)
+        metric_observe('backup_seconds', duration)
+        metric_observe('backup_writer_stall_seconds', max_step)
+        metric_inc('backup_steps', steps)
+        logger.info("Бэкап %s готов за %.1f с (%s шагов, максимальная блокировка %.3f с)",
+                    path, duration, steps, max_step)
+        paths.append(path)
+    return paths
+
+async def run_backup_scheduler():
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL)
+        try:
+            await run_backup()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            metric_inc('backup_failures')
+            logger.exception("Не удалось сделать бэкап базы")
+
+# Обслуживание базы в тихие периоды: PRAGMA optimize, incremental_vacuum и checkpoint WAL.
+# Каждый шаг - короткая операция в потоке писателя между пакетами записей, общая длительность ограничена
+MAINTENANCE_INTERVAL = float(os.getenv('MAINTENANCE_INTERVAL_HOURS', '6')) * 3600
+MAINTENANCE_TIME_BUDGET = float(os.getenv('MAINTENANCE_TIME_BUDGET', '5'))
+MAINTENANCE_VACUUM_PAGES = int(os.getenv('MAINTENANCE_VACUUM_PAGES', '256'))
+MAINTENANCE_SLICE_SLEEP = float(os.getenv('MAINTENANCE_SLICE_SLEEP', '0.05'))
+MAINTENANCE_ANALYSIS_LIMIT = int(os.getenv('MAINTENANCE_ANALYSIS_LIMIT', '1000'))
+# Тихий период: за последнюю минуту было не больше MAINTENANCE_QUIET_WRITES записей
+MAINTENANCE_QUIET_WINDOW = 60
+MAINTENANCE_QUIET_WRITES = int(os.getenv('MAINTENANCE_QUIET_WRITES', '30'))
+
+def optimize_database(conn):
+    # analysis_limit ограничивает ANALYZE выборкой строк, так что он не сканирует большие таблицы целиком
+    conn.execute(f'PRAGMA analysis_limit = {MAINTENANCE_ANALYSIS_LIMIT}')
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone() is None:
+        conn.execute('ANALYZE')
+    else:
+        conn.execute('PRAGMA optimize')
+
+def vacuum_step(conn, schema):
+    """Возвращает в файловую систему до MAINTENANCE_VACUUM_PAGES свободных страниц; результат - (байт, осталось страниц)"""
+    page_size = conn.execute(f'PRAGMA {schema}.page_size').fetchone()[0]
+    before = conn.execute(f'PRAGMA {schema}.freelist_count').fetchone()[0]
+    if before:
+        # execute() делает один шаг, а incremental_vacuum освобождает по странице за шаг;
+        # executescript прогоняет pragma до конца
+        conn.executescript(f'PRAGMA {schema}.incremental_vacuum({MAINTENANCE_VACUUM_PAGES});')
+    after = conn.execute(f'PRAGMA {schema}.freelist_count').fetchone()[0]
+    return (before - after) * page_size, after
+
+def checkpoint_wal(conn):
+    """PASSIVE не ждет читателей; если весь журнал перенесен в базу, TRUNCATE обнуляет файл WAL"""
+    wal_path = db_writer.path + '-wal'
+    size_before = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+    busy, log_frames, checkpointed = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    if not busy and log_frames == checkpointed:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    size_after = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+    return size_before - size_after, log_frames - checkpointed
+
+async def run_maintenance():
+    started = time.monotonic()
+    deadline = started + MAINTENANCE_TIME_BUDGET
+    report = {'reclaimed_bytes': 0, 'free_pages_left': 0, 'wal_bytes_truncated': 0, 'wal_frames_left': 0}
+    
+    await db_writer.run_between_batches(optimize_database)
+    # Таблица обработанных update_id растет с каждым обновлением - урезаем ее до окна до вакуума
+    report['processed_updates_pruned'] = await recent_updates.prune()
+    
+    for schema in ('main', 'archive'):
+        while True:
+            reclaimed, left = await db_writer.run_between_batches(lambda conn: vacuum_step(conn, schema))
+            report['reclaimed_bytes'] += reclaimed
+            if not left or not reclaimed or time.monotonic() >= deadline:
+                report['free_pages_left'] += left
+                break
+            await asyncio.sleep(MAINTENANCE_SLICE_SLEEP)
+    
+    truncated, frames_left = await db_writer.run_between_batches(checkpoint_wal)
+    report['wal_bytes_truncated'] = truncated
+    report['wal_frames_left'] = frames_left
+    
+    report['seconds'] = round(time.monotonic() - started, 3)
+    metric_inc('maintenance_runs')
+    metric_observe('maintenance_seconds', report['seconds'])
+    metric_inc('maintenance_reclaimed_bytes', report['reclaimed_bytes'])
+    metric_inc('processed_updates_pruned', report['processed_updates_pruned'])
+    metric_inc('maintenance_wal_bytes_truncated', max(truncated, 0))
+    logger.info("Обслуживание базы за %.3f с: освобождено %s байт, свободных страниц осталось %s, "
+                "WAL уменьшен на %s байт", report['seconds'], report['reclaimed_bytes'],
+                report['free_pages_left'], truncated)
+    return report
+
+async def run_maintenance_scheduler():
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        # Ждем тихого периода, чтобы обслуживание не мешало пиковой нагрузке
+        while True:
+            writes = METRICS['db_writes']
+            await asyncio.sleep(MAINTENANCE_QUIET_WINDOW)
+            if METRICS['db_writes'] - writes <= MAINTENANCE_QUIET_WRITES:
+                break
+        try:
+            await run_maintenance()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            metric_inc('maintenance_failures')
+            logger.exception("Не удалось выполнить обслуживание базы")
+
+# Сверка счетов: каждый оплаченный счет должен иметь ровно одно зачисление в payments,
+# неоплаченные счета через INVOICE_TTL_HOURS помечаются просроченными
+INVOICE_TTL_HOURS = int(os.getenv('INVOICE_TTL_HOURS', '24'))
+INVOICE_RECONCILE_INTERVAL = float(os.getenv('INVOICE_RECONCILE_INTERVAL', '3600'))
+
+def apply_invoice_reconciliation(cursor):
+    # Зачисление прошло, а счет остался pending (например, старая версия обработчика)
+    cursor.execute('''
+    UPDATE pending_invoices
+    SET status = 'paid',
+        charge_id = (SELECT p.charge_id FROM payments p WHERE p.payload = pending_invoices.token),
+        paid_at = (SELECT p.created_at FROM payments p WHERE p.payload = pending_invoices.token)
+    WHERE status = 'pending'
+      AND EXISTS (SELECT 1 FROM payments p WHERE p.payload = pending_invoices.token)
+    ''')
+    fixed = cursor.rowcount
+    
+    # Оплаченные счета без зачисления - требуют внимания администратора
+    cursor.execute('''
+    SELECT i.token, i.user_id, i.amount, i.charge_id
+    FROM pending_invoices i
+    LEFT JOIN payments p ON p.payload = i.token
+    WHERE i.status = 'paid' AND p.charge_id IS NULL
+    ''')
+    missing = cursor.fetchall()
+    
+    cursor.execute('''
+    UPDATE pending_invoices SET status = 'expired'
+    WHERE status = 'pending' AND created_at < datetime('now', ?)
+    ''', (f'-{INVOICE_TTL_HOURS} hours',))
+    expired = cursor.rowcount
+    return fixed, missing, expired
+
+async def reconcile_invoices():
+    fixed, missing, expired = await db_writer.execute(apply_invoice_reconciliation)
+    metric_inc('invoices_reconciled', fixed)
+    metric_inc('invoices_expired', expired)
+    METRICS['invoices_unmatched'] = len(missing)
+    for token, user_id, amount, charge_id in missing:
+        logger.error("Счет %s оплачен (платеж %s), но не зачислен пользователю %s: %s коп.",
+                     token, charge_id, user_id, amount)
+    return fixed, missing, expired
+
+async def run_invoice_reconciler():
+    while True:
+        try:
+            await reconcile_invoices()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Сбой сверки счетов")
+        await asyncio.sleep(INVOICE_RECONCILE_INTERVAL)
+
+# Защита от повторной обработки обновлений: недавние update_id держим в памяти,
+# а для переживания рестартов пишем их в таблицу processed_updates
+UPDATE_DEDUPE_WINDOW = int(os.getenv('UPDATE_DEDUPE_WINDOW', '10000'))
+
+class RecentUpdates:
+    # Повтор распознаем только по членству в окне: после сброса Bot API update_id может начаться
+    # заново с меньшего значения, поэтому сравнивать с уже вытесненными id нельзя
+    def __init__(self, size):
+        self.size = size
+        self.ids = set()
+        self.order = deque()
+
+    def add(self, update_id):
+        if update_id in self.ids:
+            return False
+        self.ids.add(update_id)
+        self.order.append(update_id)
+        if len(self.order) > self.size:
+            self.ids.discard(self.order.popleft())
+        return True
+
+    async def load(self):
+        # Окно восстанавливаем в порядке обработки, а не по величине update_id
+        def query(cursor):
+            cursor.execute('SELECT update_id FROM processed_updates ORDER BY processed_at DESC LIMIT ?',
+                           (self.size,))
+            return cursor.fetchall()
+        rows = await db_reader.execute(query)
+        for (update_id,) in reversed(rows):
+            self.add(update_id)
+        if len(rows) == self.size:
+            await self.prune()
+
+    async def prune(self):
+        """Удаляет из processed_updates записи старше окна; вызывается при старте и из run_maintenance"""
+        def apply(cursor):
+            cursor.execute('''
+            DELETE FROM processed_updates WHERE processed_at < (
+                SELECT processed_at FROM processed_updates ORDER BY processed_at DESC LIMIT 1 OFFSET ?
+            )
+            ''', (self.size - 1,))
+            return cursor.rowcount
+        return await db_writer.execute(apply)
+
+recent_updates = RecentUpdates(UPDATE_DEDUPE_WINDOW)
+
+async def record_processed_update(update_id):
+    def apply(cursor):
+        cursor.execute('INSERT OR IGNORE INTO processed_updates (update_id) VALUES (?)', (update_id,))
+    try:
+        await db_writer.execute(apply)
+    except Exception:
+        logger.exception("Не удалось сохранить update_id %s", update_id)
+
+class UpdateDedupeMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        if not recent_updates.add(update.update_id):
+            metric_inc('duplicate_updates')
+            raise CancelHandler()
+        # Запись не ждем: group commit писателя сам соберет их в пачку
+        asyncio.ensure_future(record_processed_update(update.update_id))
+
+dp.middleware.setup(UpdateDedupeMiddleware())
+
+# Ранний ответ на callback-запросы
+# Через сколько секунд после получения callback отвечаем на него, даже если обработчик
+# еще не закончил работу (0 - отвечаем сразу)
+CALLBACK_ACK_DELAY = float(os.getenv('CALLBACK_ACK_DELAY', '0.2'))
+
+class CallbackAck:
+    def __init__(self, query_id, chat_id):
+        self.query_id = query_id
+        self.chat_id = chat_id
+        self.received_at = time.monotonic()
+        self.answered = False
+        self.timer = None
+
+    async def answer(self, text=None, show_alert=False):
+        if self.answered:
+            # Кнопка уже "отпущена" - всплывающее уведомление показать нельзя. Обычные подсказки
+            # отбрасываем, а важные (show_alert - отказ после проверки в базе) отправляем сообщением
+            if text:
+                metric_inc('callback_late_notices')
+                if not show_alert:
+                    return False
+                try:
+                    await bot.send_message(self.chat_id, text)
+                except TelegramAPIError as e:
+                    logger.warning("Не удалось отправить уведомление для callback %s: %s", self.query_id, e)
+            return False
+        self.answered = True
+        if self.timer:
+            self.timer.cancel()
+        metric_observe('callback_ack_seconds', time.monotonic() - self.received_at)
+        try:
+            await bot.answer_callback_query(self.query_id, text, show_alert=show_alert)
+        except TelegramAPIError as e:
+            logger.warning("Не удалось ответить на callback %s: %s", self.query_id, e)
+        return True
+
+    def expire(self):
+        self.timer = None
+        if not self.answered:
+            metric_inc('callback_early_acks')
+            asyncio.ensure_future(self.answer())
+
+pending_callback_acks = {}
+
+class CallbackAckMiddleware(BaseMiddleware):
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        ack = CallbackAck(callback_query.id, callback_query.from_user.id)
+        pending_callback_acks[callback_query.id] = ack
+        if CALLBACK_ACK_DELAY <= 0:
+            await ack.answer()
+        else:
+            ack.timer = asyncio.get_event_loop().call_later(CALLBACK_ACK_DELAY, ack.expire)
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        ack = pending_callback_acks.pop(callback_query.id, None)
+        if not ack:
+            return
+        # Обработчик мог вообще не ответить на callback - снимаем "часики" с кнопки
+        await ack.answer()
+        metric_observe('callback_handler_seconds', time.monotonic() - ack.received_at)
+
+async def answer_callback(callback_query, text=None, show_alert=False):
+    ack = pending_callback_acks.get(callback_query.id)
+    if ack:
+        return await ack.answer(text, show_alert=show_alert)
+    await bot.answer_callback_query(callback_query.id, text, show_alert=show_alert)
+    return True
+
+dp.middleware.setup(CallbackAckMiddleware())
+
+# Кэш отрисованных сообщений: хэш текста и клавиатуры по (chat_id, message_id),
+# чтобы не отправлять в Telegram редактирование, которое ничего не меняет
+EDIT_CACHE_SIZE = int(os.getenv('EDIT_CACHE_SIZE', '10000'))
+
+rendered_messages = OrderedDict()
+
+def rendered_hash(text, parse_mode, reply_markup):
+    markup = reply_markup.as_json() if reply_markup is not None else ''
+    return hashlib.blake2b(f"{parse_mode}\0{text}\0{markup}".encode(), digest_size=8).digest()
+
+def remember_rendered(key, digest):
+    rendered_messages[key] = digest
+    rendered_messages.move_to_end(key)
+    if len(rendered_messages) > EDIT_CACHE_SIZE:
+        rendered_messages.popitem(last=False)
+
+async def edit_message_text(chat_id, message_id, text, parse_mode=None, reply_markup=None):
+    key = (chat_id, message_id)
+    digest = rendered_hash(text, parse_mode, reply_markup)
+    if rendered_messages.get(key) == digest:
+        rendered_messages.move_to_end(key)
+        metric_inc('edits_skipped')
+        return None
+    try:
+        result = await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text,
+                                             parse_mode=parse_mode, reply_markup=reply_markup)
+    except MessageNotModified:
+        metric_inc('edits_not_modified')
+        result = None
+    remember_rendered(key, digest)
+    metric_inc('edits_sent')
+    return result
+
+# Защита от флуда: token bucket на пользователя и на пару (пользователь, обработчик).
+# Лишние обновления отбрасываются до того, как обработчик пойдет в базу или Telegram API
+FLOOD_USER_RATE = float(os.getenv('FLOOD_USER_RATE', '3'))  # токенов в секунду
+FLOOD_USER_BURST = float(os.getenv('FLOOD_USER_BURST', '15'))
+FLOOD_HANDLER_RATE = float(os.getenv('FLOOD_HANDLER_RATE', '1'))
+FLOOD_HANDLER_BURST = float(os.getenv('FLOOD_HANDLER_BURST', '5'))
+FLOOD_IDLE_TTL = float(os.getenv('FLOOD_IDLE_TTL', '300'))
+
+class TokenBuckets:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # ключ -> (токены, время последнего обновления)
+        self.last_sweep = time.monotonic()
+
+    def consume(self, key):
+        now = time.monotonic()
+        tokens, stamp = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        if now - self.last_sweep > FLOOD_IDLE_TTL:
+            self.sweep(now)
+        return allowed
+
+    def sweep(self, now):
+        # Ведро, которое простаивало дольше FLOOD_IDLE_TTL, все равно уже полное - его можно забыть
+        self.buckets = {key: value for key, value in self.buckets.items() if now - value[1] <= FLOOD_IDLE_TTL}
+        self.last_sweep = now
+
+user_buckets = TokenBuckets(FLOOD_USER_RATE, FLOOD_USER_BURST)
+handler_buckets = TokenBuckets(FLOOD_HANDLER_RATE, FLOOD_HANDLER_BURST)
+
+FLOOD_NOTICE = "⏳ Слишком много запросов, попробуйте чуть позже."
+
+class AntiFloodMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        if update.callback_query:
+            user_id = update.callback_query.from_user.id
+        elif update.message and not update.message.successful_payment:
+            user_id = update.message.from_user.id
+        else:
+            # Платежи и служебные обновления не ограничиваем
+            return
+        if is_admin(user_id) or user_buckets.consume(user_id):
+            return
+        
+        metric_inc('throttled_updates')
+        METRICS['flood_buckets'] = len(user_buckets.buckets) + len(handler_buckets.buckets)
+        if update.callback_query:
+            try:
+                await bot.answer_callback_query(update.callback_query.id, FLOOD_NOTICE)
+            except TelegramAPIError:
+                pass
+        raise CancelHandler()
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        if message.successful_payment or is_admin(message.from_user.id):
+            return
+        if not handler_buckets.consume((message.from_user.id, current_handler.get().__name__)):
+            metric_inc('throttled_handler_calls')
+            raise CancelHandler()
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        if is_admin(callback_query.from_user.id):
+            return
+        if not handler_buckets.consume((callback_query.from_user.id, current_handler.get().__name__)):
+            metric_inc('throttled_handler_calls')
+            await answer_callback(callback_query, FLOOD_NOTICE)
+            raise CancelHandler()
+
+dp.middleware.setup(AntiFloodMiddleware())
 
 # Обработчики команд
 @dp.message_handler(commands=['start'])
 async def send_welcome(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username
-    create_user(user_id, username)
+    await create_user(user_id, username)
     
     keyboard = InlineKeyboardMarkup()
     keyboard.add(InlineKeyboardButton("🛒 Магазин", callback_data="shop"))
@@ -268,103 +2624,131 @@ async def send_welcome(message: types.Message):
 
 @dp.callback_query_handler(lambda c: c.data == 'shop')
 async def show_shop(callback_query: types.CallbackQuery):
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT DISTINCT category FROM products WHERE is_active = TRUE')
-    categories = cursor.fetchall()
-    conn.close()
+    categories = await get_active_categories()
     
     keyboard = InlineKeyboardMarkup()
     for category in categories:
-        keyboard.add(InlineKeyboardButton(category[0], callback_data=f"category_{category[0]}"))
+        keyboard.add(InlineKeyboardButton(f"{category[1]} ({category[2]})", callback_data=f"category_{category[0]}"))
     keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_main"))
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text="🛍 Выберите категорию товаров:",
                               reply_markup=keyboard)
 
 @dp.callback_query_handler(lambda c: c.data.startswith('category_'))
 async def show_category_products(callback_query: types.CallbackQuery):
-    category = callback_query.data.replace('category_', '')
+    category = await get_category(callback_query.data.replace('category_', ''))
+    if not category:
+        await answer_callback(callback_query, "Категория не найдена!")
+        return
     
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    SELECT p.product_id, p.title, p.price, u.username 
-    FROM products p
-    JOIN users u ON p.seller_id = u.user_id
-    WHERE p.category = ? AND p.is_active = TRUE
-    ''', (category,))
-    products = cursor.fetchall()
-    conn.close()
+    products = await get_category_products(category[0])
     
     keyboard = InlineKeyboardMarkup()
     for product in products:
-        keyboard.add(InlineKeyboardButton(f"{product[1]} - {product[2]}₽ ({product[3]})", 
+        stock = f" · {product[4]} шт." if product[4] is not None else ""
+        keyboard.add(InlineKeyboardButton(f"{product[1]} - {product[2]}₽ ({product[3]}){stock}", 
                                          callback_data=f"product_{product[0]}"))
     keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="shop"))
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
-                              text=f"📦 Товары в категории {category}:",
+                              text=f"📦 Товары в категории {category[1]}:",
                               reply_markup=keyboard)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('product_'))
+# product_keys_ и product_stock_ тоже начинаются с product_, поэтому здесь только product_<id>
+@dp.callback_query_handler(lambda c: re.fullmatch(r'product_\d+', c.data))
 async def show_product(callback_query: types.CallbackQuery):
     product_id = int(callback_query.data.replace('product_', ''))
-    product = get_product(product_id)
+    product = await get_product(product_id)
     
     if not product:
-        await bot.answer_callback_query(callback_query.id, "Товар не найден!")
+        await answer_callback(callback_query, "Товар не найден!")
         return
     
-    seller_info = get_user(product[1])
+    seller_info = await get_user(product[1])
     seller_username = seller_info[1] if seller_info else "Неизвестный"
-    seller_rating = seller_info[3] if seller_info else "Нет оценок"
+    seller_rating = format_rating(seller_info)
     
     keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("🛒 Купить", callback_data=f"buy_{product_id}"))
-    keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data=f"category_{product[4]}"))
-    
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    in_stock = product[7] and (product[11] is None or product[11] > 0)
+    if in_stock:
+        keyboard.add(InlineKeyboardButton("🛒 Купить", callback_data=f"buy_{product_id}"))
+    keyboard.add(InlineKeyboardButton("💬 Отзывы", callback_data=f"reviews_{product_id}_0"))
+    keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data=f"category_{product[8]}"))
+    
+    stock_text = ""
+    if product[9]:
+        stock_text += "\n⚡ Мгновенная выдача"
+    if product[11] is not None:
+        stock_text += f"\n📦 В наличии: <b>{product[11]} шт.</b>"
+    
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text=f"""📦 <b>{product[2]}</b>
 
 💰 Цена: <b>{product[4]}₽</b>
-👤 Продавец: <b>{seller_username}</b> (рейтинг: {seller_rating})
+👤 Продавец: <b>{seller_username}</b> (рейтинг: {seller_rating}){stock_text}
 📝 Описание:
 {product[3]}
 
-🛒 Нажмите кнопку ниже, чтобы купить товар.""",
+{"🛒 Нажмите кнопку ниже, чтобы купить товар." if in_stock else "❌ Товар закончился."}""",
                               parse_mode='HTML',
                               reply_markup=keyboard)
 
 @dp.callback_query_handler(lambda c: c.data.startswith('buy_'))
 async def buy_product(callback_query: types.CallbackQuery):
     product_id = int(callback_query.data.replace('buy_', ''))
-    product = get_product(product_id)
+    product = await get_product(product_id)
     buyer_id = callback_query.from_user.id
     
     if not product:
-        await bot.answer_callback_query(callback_query.id, "Товар не найден!")
+        await answer_callback(callback_query, "Товар не найден!")
         return
     
     if product[1] == buyer_id:
-        await bot.answer_callback_query(callback_query.id, "Вы не можете купить свой собственный товар!")
+        await answer_callback(callback_query, "Вы не можете купить свой собственный товар!")
         return
     
     # Проверяем баланс покупателя
-    buyer = get_user(buyer_id)
+    buyer = await get_user(buyer_id)
     if buyer[2] < product[4]:
-        await bot.answer_callback_query(callback_query.id, "Недостаточно средств на балансе!")
+        await answer_callback(callback_query, "Недостаточно средств на балансе!", show_alert=True)
         return
     
-    # Создаем сделку
-    deal_id = create_deal(buyer_id, product[1], product_id, product[4])
+    # Создаем сделку и замораживаем деньги у покупателя
+    deal_id = await create_deal(buyer_id, product[1], product_id, product[4])
+    if deal_id is False:
+        await answer_callback(callback_query, "Товар закончился!", show_alert=True)
+        return
+    if not deal_id:
+        await answer_callback(callback_query, "Недостаточно средств на балансе!", show_alert=True)
+        return
     
-    # Замораживаем деньги у покупателя
-    update_balance(buyer_id, -product[4])
+    seller = await get_user(product[1])
+    
+    if product[9]:
+        # Ключ уже выдан покупателю через очередь уведомлений в транзакции покупки
+        await bot.send_message(product[1], f"""🛒 Новый заказ!
+Покупатель: @{callback_query.from_user.username}
+Товар: {product[2]}
+Сумма: {product[4]}₽
+
+🔑 Ключ выдан покупателю автоматически.""")
+        
+        await edit_message_text(chat_id=callback_query.message.chat.id,
+                                  message_id=callback_query.message.message_id,
+                                  text=f"""🛒 Ваш заказ создан!
+Товар: {product[2]}
+Продавец: @{seller[1]}
+Сумма: {product[4]}₽
+Статус: Товар выдан
+
+🔑 Ключ отправлен вам отдельным сообщением.""")
+        
+        await answer_callback(callback_query, "Товар выдан! Деньги заморожены до подтверждения.")
+        return
     
     # Уведомляем продавца
     seller_keyboard = InlineKeyboardMarkup()
@@ -384,115 +2768,229 @@ async def buy_product(callback_query: types.CallbackQuery):
     deal_keyboard.add(InlineKeyboardButton("✅ Подтвердить получение", callback_data=f"confirm_{deal_id}"))
     deal_keyboard.add(InlineKeyboardButton("⚠️ Открыть диспут", callback_data=f"dispute_{deal_id}"))
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text=f"""🛒 Ваш заказ создан!
 Товар: {product[2]}
-Продавец: @{get_user(product[1])[1]}
+Продавец: @{seller[1]}
 Сумма: {product[4]}₽
 Статус: Ожидает отправки
 
 После получения товара нажмите кнопку подтверждения.""",
                               reply_markup=deal_keyboard)
     
-    await bot.answer_callback_query(callback_query.id, "Заказ создан! Деньги заморожены.")
+    await answer_callback(callback_query, "Заказ создан! Деньги заморожены.")
 
 @dp.callback_query_handler(lambda c: c.data.startswith('send_'))
 async def send_product(callback_query: types.CallbackQuery):
     deal_id = callback_query.data.replace('send_', '')
-    deal = get_deal(deal_id)
+    deal = await get_deal(deal_id)
     
     if not deal:
-        await bot.answer_callback_query(callback_query.id, "Сделка не найдена!")
+        await answer_callback(callback_query, "Сделка не найдена!")
         return
     
     if callback_query.from_user.id != deal[2]:  # Проверяем, что это продавец
-        await bot.answer_callback_query(callback_query.id, "Вы не являетесь продавцом!")
+        await answer_callback(callback_query, "Вы не являетесь продавцом!")
+        return
+    
+    if deal[5] != 'pending':
+        await answer_callback(callback_query, "Товар уже отправлен!")
         return
     
-    # Обновляем статус сделки
-    update_deal_status(deal_id, 'sent')
+    product = await get_product(deal[3])
     
-    # Уведомляем покупателя
+    # Уведомление покупателю
     deal_keyboard = InlineKeyboardMarkup()
     deal_keyboard.add(InlineKeyboardButton("✅ Подтвердить получение", callback_data=f"confirm_{deal_id}"))
     deal_keyboard.add(InlineKeyboardButton("⚠️ Открыть диспут", callback_data=f"dispute_{deal_id}"))
     
-    await bot.send_message(deal[1],  # buyer_id
-                          f"""📦 Продавец отправил товар!
-Товар: {get_product(deal[3])[2]}
+    buyer_notification = notification(deal[1],  # buyer_id
+                                      f"""📦 Продавец отправил товар!
+Товар: {product[2]}
+Сумма: {deal[4]}₽
+
+После получения товара подтвердите его получение.""",
+                                      reply_markup=deal_keyboard,
+                                      dedupe_key=f"{deal_id}:sent:buyer")
+    
+    # Обновляем статус сделки вместе с постановкой уведомления в очередь
+    if not await mark_deal_sent(deal_id, [buyer_notification]):
+        await answer_callback(callback_query, "Сделка уже закрыта или товар уже отправлен!", show_alert=True)
+        return
+    
+    await edit_message_text(chat_id=callback_query.message.chat.id,
+                              message_id=callback_query.message.message_id,
+                              text="✅ Вы отправили товар покупателю. Ожидайте подтверждения получения.")
+    
+    await answer_callback(callback_query, "Товар отправлен!")
+
+@dp.callback_query_handler(lambda c: c.data.startswith('confirm_'))
+async def confirm_deal(callback_query: types.CallbackQuery):
+    deal_id = callback_query.data.replace('confirm_', '')
+    deal = await get_deal(deal_id)
+    
+    if not deal:
+        await answer_callback(callback_query, "Сделка не найдена!")
+        return
+    
+    if callback_query.from_user.id != deal[1]:  # Проверяем, что это покупатель
+        await answer_callback(callback_query, "Вы не являетесь покупателем!")
+        return
+    
+    if deal[5] != 'sent':  # Проверяем, что товар отправлен
+        await answer_callback(callback_query, "Товар еще не отправлен!")
+        return
+    
+    # Подтверждаем сделку от покупателя и ставим уведомление продавцу в очередь
+    completed = await confirm_deal_for_user(deal_id, 'buyer', [
+        notification(deal[2],  # seller_id
+                     f"""✅ Покупатель подтвердил получение товара!
+Сделка #{deal_id} завершена.
 Сумма: {deal[4]}₽
-
-После получения товара подтвердите его получение.""",
-                          reply_markup=deal_keyboard)
+Ваш заработок: {deal[4] - deal[8]}₽ (за вычетом комиссии)""",
+                     dedupe_key=f"{deal_id}:confirmed:seller"),
+    ])
+    if completed is None:
+        await answer_callback(callback_query, "Сделка уже закрыта!", show_alert=True)
+        return
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
-                              text="✅ Вы отправили товар покупателю. Ожидайте подтверждения получения.")
+                              text="✅ Вы подтвердили получение товара. Сделка завершена!\n\n⭐ Оцените продавца:",
+                              reply_markup=review_keyboard(deal_id))
     
-    await bot.answer_callback_query(callback_query.id, "Товар отправлен!")
+    await answer_callback(callback_query, "Сделка подтверждена!")
 
-@dp.callback_query_handler(lambda c: c.data.startswith('confirm_'))
-async def confirm_deal(callback_query: types.CallbackQuery):
-    deal_id = callback_query.data.replace('confirm_', '')
-    deal = get_deal(deal_id)
+REVIEWS_PAGE_SIZE = 5
+REVIEW_MAX_LENGTH = 500
+
+def review_keyboard(deal_id):
+    keyboard = InlineKeyboardMarkup(row_width=5)
+    keyboard.add(*[InlineKeyboardButton("⭐" * stars, callback_data=f"review_{deal_id}_{stars}")
+                   for stars in REVIEW_STARS])
+    return keyboard
+
+@dp.callback_query_handler(lambda c: c.data.startswith('review_'))
+async def rate_deal(callback_query: types.CallbackQuery):
+    deal_id, _, stars = callback_query.data.replace('review_', '').rpartition('_')
+    # callback_data приходит от клиента - оценку вне 1..5 не принимаем
+    if not stars.isdigit() or int(stars) not in REVIEW_STARS:
+        await answer_callback(callback_query, "Некорректная оценка!")
+        return
+    stars = int(stars)
+    deal = await get_deal(deal_id, include_archive=True)
     
-    if not deal:
-        await bot.answer_callback_query(callback_query.id, "Сделка не найдена!")
+    if not deal or callback_query.from_user.id != deal[1]:
+        await answer_callback(callback_query, "Сделка не найдена!")
         return
     
-    if callback_query.from_user.id != deal[1]:  # Проверяем, что это покупатель
-        await bot.answer_callback_query(callback_query.id, "Вы не являетесь покупателем!")
+    if deal[5] != 'completed':
+        await answer_callback(callback_query, "Отзыв можно оставить только после завершения сделки!")
         return
     
-    if deal[5] != 'sent':  # Проверяем, что товар отправлен
-        await bot.answer_callback_query(callback_query.id, "Товар еще не отправлен!")
+    if await has_review(deal_id):
+        await answer_callback(callback_query, "Вы уже оставили отзыв по этой сделке!")
         return
     
-    # Подтверждаем сделку от покупателя
-    confirm_deal_for_user(deal_id, 'buyer')
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("Без комментария", callback_data="skip_review"))
     
-    # Уведомляем продавца
-    await bot.send_message(deal[2],  # seller_id
-                         f"""✅ Покупатель подтвердил получение товара!
-Сделка #{deal_id} завершена.
-Сумма: {deal[4]}₽
-Ваш заработок: {deal[4] - deal[8]}₽ (за вычетом комиссии)""")
+    await edit_message_text(chat_id=callback_query.message.chat.id,
+                              message_id=callback_query.message.message_id,
+                              text=f"Ваша оценка: {'⭐' * stars}\n\n✏️ Напишите комментарий к отзыву:",
+                              reply_markup=keyboard)
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await Form.review_text.set()
+    state = Dispatcher.get_current().current_state()
+    await state.update_data(deal_id=deal_id, rating=stars)
+    
+    await answer_callback(callback_query)
+
+async def save_review(user_id, state, text=None):
+    data = await state.get_data()
+    await state.finish()
+    saved = await add_review(data['deal_id'], user_id, data['rating'], text)
+    if saved:
+        return "✅ Спасибо! Ваш отзыв опубликован."
+    if saved is False:
+        return "Вы уже оставили отзыв по этой сделке."
+    return "Отзыв по этой сделке оставить нельзя."
+
+@dp.callback_query_handler(lambda c: c.data == 'skip_review', state=Form.review_text)
+async def skip_review_text(callback_query: types.CallbackQuery, state: FSMContext):
+    text = await save_review(callback_query.from_user.id, state)
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
-                              text="✅ Вы подтвердили получение товара. Сделка завершена!")
+                              text=text)
+    await answer_callback(callback_query)
+
+@dp.message_handler(state=Form.review_text)
+async def process_review_text(message: types.Message, state: FSMContext):
+    await message.reply(await save_review(message.from_user.id, state, message.text[:REVIEW_MAX_LENGTH]))
+
+@dp.callback_query_handler(lambda c: c.data.startswith('reviews_'))
+async def show_product_reviews(callback_query: types.CallbackQuery):
+    product_id, before_id = map(int, callback_query.data.replace('reviews_', '').split('_'))
+    count, reviews = await get_product_reviews(product_id, before_id, REVIEWS_PAGE_SIZE)
     
-    await bot.answer_callback_query(callback_query.id, "Сделка подтверждена!")
+    if not reviews:
+        text = "💬 У этого товара пока нет отзывов."
+    else:
+        text = f"💬 Отзывы о товаре ({count}):"
+        for review_id, username, rating, review_text, created_at in reviews:
+            text += f"\n\n{'⭐' * rating} @{username} ({created_at})"
+            if review_text:
+                text += f"\n{review_text}"
+    
+    keyboard = InlineKeyboardMarkup()
+    navigation = []
+    if before_id:
+        navigation.append(InlineKeyboardButton("⏮ К новым", callback_data=f"reviews_{product_id}_0"))
+    if len(reviews) == REVIEWS_PAGE_SIZE:
+        navigation.append(InlineKeyboardButton("Дальше ▶️", callback_data=f"reviews_{product_id}_{reviews[-1][0]}"))
+    if navigation:
+        keyboard.add(*navigation)
+    keyboard.add(InlineKeyboardButton("🔙 К товару", callback_data=f"product_{product_id}"))
+    
+    await edit_message_text(chat_id=callback_query.message.chat.id,
+                              message_id=callback_query.message.message_id,
+                              text=text,
+                              reply_markup=keyboard)
+
+def dispute_actions_keyboard(deal_id):
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("💬 Ответить", callback_data=f"admin_reply_{deal_id}"))
+    keyboard.add(InlineKeyboardButton("🔙 Вернуть деньги покупателю", callback_data=f"refund_{deal_id}"))
+    keyboard.add(InlineKeyboardButton("💰 Передать деньги продавцу", callback_data=f"pay_seller_{deal_id}"))
+    return keyboard
 
 @dp.callback_query_handler(lambda c: c.data.startswith('dispute_'))
 async def start_dispute(callback_query: types.CallbackQuery):
     deal_id = callback_query.data.replace('dispute_', '')
-    deal = get_deal(deal_id)
+    deal = await get_deal(deal_id)
     
     if not deal:
-        await bot.answer_callback_query(callback_query.id, "Сделка не найдена!")
+        await answer_callback(callback_query, "Сделка не найдена!")
         return
     
     user_id = callback_query.from_user.id
     if user_id not in (deal[1], deal[2]):  # Проверяем, что это участник сделки
-        await bot.answer_callback_query(callback_query.id, "Вы не участник сделки!")
+        await answer_callback(callback_query, "Вы не участник сделки!")
         return
     
-    # Устанавливаем статус диспута
-    update_deal_status(deal_id, 'dispute')
-    
-    # Уведомляем администратора
-    product = get_product(deal[3])
-    buyer = get_user(deal[1])
-    seller = get_user(deal[2])
+    if deal[5] not in ('pending', 'sent'):
+        await answer_callback(callback_query, "По этой сделке нельзя открыть диспут!")
+        return
     
-    dispute_keyboard = InlineKeyboardMarkup()
-    dispute_keyboard.add(InlineKeyboardButton("💬 Ответить", callback_data=f"admin_reply_{deal_id}"))
-    dispute_keyboard.add(InlineKeyboardButton("🔙 Вернуть деньги покупателю", callback_data=f"refund_{deal_id}"))
-    dispute_keyboard.add(InlineKeyboardButton("💰 Передать деньги продавцу", callback_data=f"pay_seller_{deal_id}"))
+    product = await get_product(deal[3])
+    buyer = await get_user(deal[1])
+    seller = await get_user(deal[2])
     
-    await bot.send_message(ADMIN_ID,
+    def dispute_notifications(admin_id):
+        # Назначенному администратору - карточка диспута, участникам - уведомление об открытии
+        return [
+            notification(admin_id,
                          f"""⚠️ ОТКРЫТ ДИСПУТ!
 Сделка: #{deal_id}
 Товар: {product[2]}
@@ -501,18 +2999,22 @@ async def start_dispute(callback_query: types.CallbackQuery):
 Сумма: {deal[4]}₽
 
 Выберите действие:""",
-                         reply_markup=dispute_keyboard)
-    
-    # Уведомляем участников
-    await bot.send_message(deal[1], 
-                         f"""⚠️ По сделке #{deal_id} открыт диспут. 
-Администратор рассмотрит вашу ситуацию в ближайшее время.""")
-    
-    await bot.send_message(deal[2], 
+                         reply_markup=dispute_actions_keyboard(deal_id),
+                         dedupe_key=f"{deal_id}:dispute:admin"),
+        ] + [
+            notification(participant_id,
                          f"""⚠️ По сделке #{deal_id} открыт диспут. 
-Администратор рассмотрит вашу ситуацию в ближайшее время.""")
+Администратор рассмотрит вашу ситуацию в ближайшее время.""",
+                         dedupe_key=f"{deal_id}:dispute:{participant_id}")
+            for participant_id in (deal[1], deal[2])
+        ]
+    
+    # Переводим сделку в диспут, назначаем администратора и ставим уведомления в очередь одной транзакцией
+    if await open_dispute(deal_id, user_id, dispute_notifications) is None:
+        await answer_callback(callback_query, "По этой сделке нельзя открыть диспут!")
+        return
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text="""⚠️ Диспут открыт! 
 Опишите проблему в одном сообщении, и администратор рассмотрит ваш случай.""")
@@ -521,7 +3023,7 @@ async def start_dispute(callback_query: types.CallbackQuery):
     state = Dispatcher.get_current().current_state()
     await state.update_data(deal_id=deal_id, user_id=user_id)
     
-    await bot.answer_callback_query(callback_query.id, "Диспут открыт!")
+    await answer_callback(callback_query, "Диспут открыт!")
 
 @dp.message_handler(state=Form.dispute_message)
 async def process_dispute_message(message: types.Message, state: FSMContext):
@@ -530,11 +3032,12 @@ async def process_dispute_message(message: types.Message, state: FSMContext):
     user_id = data['user_id']
     
     # Сохраняем сообщение в диспуте
-    add_dispute_message(deal_id, user_id, message.text)
+    await add_dispute_message(deal_id, user_id, message.text)
     
-    # Пересылаем сообщение администратору
-    user = get_user(user_id)
-    await bot.send_message(ADMIN_ID,
+    # Пересылаем сообщение ответственному администратору
+    user = await get_user(user_id)
+    dispute = await get_dispute(deal_id)
+    await bot.send_message(dispute[3] if dispute and dispute[3] else ADMIN_ID,
                          f"""✉️ Новое сообщение в диспуте #{deal_id}
 От: @{user[1]} (ID: {user[0]})
 Сообщение:
@@ -547,7 +3050,11 @@ async def process_dispute_message(message: types.Message, state: FSMContext):
 async def admin_reply_to_dispute(callback_query: types.CallbackQuery):
     deal_id = callback_query.data.replace('admin_reply_', '')
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    if not is_admin(callback_query.from_user.id):
+        await answer_callback(callback_query, "Только администратор может выполнить это действие!")
+        return
+    
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text="Введите ваш ответ на диспут:")
     
@@ -555,7 +3062,7 @@ async def admin_reply_to_dispute(callback_query: types.CallbackQuery):
     state = Dispatcher.get_current().current_state()
     await state.update_data(deal_id=deal_id, is_admin=True)
     
-    await bot.answer_callback_query(callback_query.id, "Введите сообщение")
+    await answer_callback(callback_query, "Введите сообщение")
 
 @dp.message_handler(state=Form.admin_message)
 async def process_admin_message(message: types.Message, state: FSMContext):
@@ -565,7 +3072,7 @@ async def process_admin_message(message: types.Message, state: FSMContext):
     
     if is_admin:
         # Получаем участников сделки
-        deal = get_deal(deal_id)
+        deal = await get_deal(deal_id)
         buyer_id = deal[1]
         seller_id = deal[2]
         
@@ -588,84 +3095,72 @@ async def process_admin_message(message: types.Message, state: FSMContext):
 @dp.callback_query_handler(lambda c: c.data.startswith('refund_'))
 async def refund_to_buyer(callback_query: types.CallbackQuery):
     deal_id = callback_query.data.replace('refund_', '')
-    deal = get_deal(deal_id)
+    deal = await get_deal(deal_id)
     
     if not deal:
-        await bot.answer_callback_query(callback_query.id, "Сделка не найдена!")
+        await answer_callback(callback_query, "Сделка не найдена!")
         return
     
-    if callback_query.from_user.id != ADMIN_ID:
-        await bot.answer_callback_query(callback_query.id, "Только администратор может выполнить это действие!")
+    if not is_admin(callback_query.from_user.id):
+        await answer_callback(callback_query, "Только администратор может выполнить это действие!")
         return
     
-    # Возвращаем деньги покупателю
-    update_balance(deal[1], deal[4])
-    
-    # Обновляем статус сделки
-    update_deal_status(deal_id, 'refunded')
-    
-    # Уведомляем участников
-    await bot.send_message(deal[1],  # buyer
-                         f"""💰 По диспуту #{deal_id} администратор принял решение вернуть вам деньги.
-Сумма {deal[4]}₽ возвращена на ваш баланс.""")
+    if deal[5] in ('completed', 'refunded'):
+        await answer_callback(callback_query, "Сделка уже закрыта!", show_alert=True)
+        return
     
-    await bot.send_message(deal[2],  # seller
-                         f"""ℹ️ По диспуту #{deal_id} администратор принял решение вернуть деньги покупателю.""")
+    # Возвращаем деньги покупателю, обновляем статус и уведомляем участников одной транзакцией
+    if not await refund_deal(deal_id, resolution_notifications(deal_id, 'refund', deal[1], deal[2], deal[4], deal[8])):
+        await answer_callback(callback_query, "Сделка уже закрыта!", show_alert=True)
+        return
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text=f"✅ Деньги возвращены покупателю по сделке #{deal_id}")
     
-    await bot.answer_callback_query(callback_query.id, "Деньги возвращены!")
+    await answer_callback(callback_query, "Деньги возвращены!")
 
 @dp.callback_query_handler(lambda c: c.data.startswith('pay_seller_'))
 async def pay_to_seller(callback_query: types.CallbackQuery):
     deal_id = callback_query.data.replace('pay_seller_', '')
-    deal = get_deal(deal_id)
+    deal = await get_deal(deal_id)
     
     if not deal:
-        await bot.answer_callback_query(callback_query.id, "Сделка не найдена!")
+        await answer_callback(callback_query, "Сделка не найдена!")
         return
     
-    if callback_query.from_user.id != ADMIN_ID:
-        await bot.answer_callback_query(callback_query.id, "Только администратор может выполнить это действие!")
+    if not is_admin(callback_query.from_user.id):
+        await answer_callback(callback_query, "Только администратор может выполнить это действие!")
         return
     
-    # Передаем деньги продавцу (за вычетом комиссии)
-    seller_amount = deal[4] - deal[8]
-    update_balance(deal[2], seller_amount)
-    
-    # Комиссия администратору
-    update_balance(ADMIN_ID, deal[8])
-    
-    # Обновляем статус сделки
-    update_deal_status(deal_id, 'completed')
-    
-    # Уведомляем участников
-    await bot.send_message(deal[1],  # buyer
-                         f"""ℹ️ По диспуту #{deal_id} администратор принял решение передать деньги продавцу.""")
+    if deal[5] in ('completed', 'refunded'):
+        await answer_callback(callback_query, "Сделка уже закрыта!", show_alert=True)
+        return
     
-    await bot.send_message(deal[2],  # seller
-                         f"""💰 По диспуту #{deal_id} администратор принял решение передать вам деньги.
-Сумма {seller_amount}₽ зачислена на ваш баланс (за вычетом комиссии {deal[8]}₽).""")
+    # Передаем деньги продавцу (за вычетом комиссии), комиссию администратору,
+    # обновляем статус и уведомляем участников одной транзакцией
+    if not await pay_deal_to_seller(deal_id,
+                                    resolution_notifications(deal_id, 'pay', deal[1], deal[2], deal[4], deal[8])):
+        await answer_callback(callback_query, "Сделка уже закрыта!", show_alert=True)
+        return
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text=f"✅ Деньги переданы продавцу по сделке #{deal_id}")
     
-    await bot.answer_callback_query(callback_query.id, "Деньги переданы!")
+    await answer_callback(callback_query, "Деньги переданы!")
 
 @dp.callback_query_handler(lambda c: c.data == 'balance')
 async def show_balance(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id)
     
     keyboard = InlineKeyboardMarkup()
     keyboard.add(InlineKeyboardButton("💳 Пополнить баланс", callback_data="top_up"))
     keyboard.add(InlineKeyboardButton("💰 Вывести средства", callback_data="withdraw"))
     keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_main"))
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text=f"""💰 Ваш баланс: <b>{user[2]}₽</b>
 
@@ -675,12 +3170,12 @@ async def show_balance(callback_query: types.CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == 'top_up')
 async def top_up_balance(callback_query: types.CallbackQuery):
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text="💳 Введите сумму для пополнения (в рублях):")
     
     await Form.top_up_amount.set()
-    await bot.answer_callback_query(callback_query.id)
+    await answer_callback(callback_query)
 
 @dp.message_handler(state=Form.top_up_amount)
 async def process_top_up_amount(message: types.Message, state: FSMContext):
@@ -693,7 +3188,9 @@ async def process_top_up_amount(message: types.Message, state: FSMContext):
         return
     
     # Создаем счет для оплаты через Telegram Payments
-    prices = [LabeledPrice(label="Пополнение баланса", amount=int(amount * 100))]
+    amount_kopecks = round(amount * 100)
+    token = await create_invoice(message.from_user.id, amount_kopecks, 'RUB')
+    prices = [LabeledPrice(label="Пополнение баланса", amount=amount_kopecks)]
     
     await bot.send_invoice(
         message.chat.id,
@@ -702,39 +3199,79 @@ async def process_top_up_amount(message: types.Message, state: FSMContext):
         provider_token=PROVIDER_TOKEN,
         currency="rub",
         prices=prices,
-        payload=f"topup_{message.from_user.id}_{amount}"
+        payload=token
     )
     
     await state.finish()
 
 @dp.pre_checkout_query_handler()
 async def process_pre_checkout_query(pre_checkout_query: types.PreCheckoutQuery):
-    await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
+    started = time.monotonic()
+    payload = pre_checkout_query.invoice_payload
+    
+    if payload.startswith('topup_'):
+        # Счета, выставленные до перехода на токены
+        await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
+        return
+    
+    invoice = await get_invoice(payload)
+    error = None
+    if not invoice:
+        error = "Счет не найден. Создайте новый счет на пополнение."
+    elif invoice[4] != 'pending':
+        error = "Этот счет уже оплачен."
+    elif invoice[1] != pre_checkout_query.from_user.id:
+        error = "Этот счет выставлен другому пользователю."
+    elif invoice[2] != pre_checkout_query.total_amount or invoice[3] != pre_checkout_query.currency.upper():
+        error = "Сумма счета не совпадает."
+    
+    if error:
+        metric_inc('pre_checkout_rejected')
+        await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=False, error_message=error)
+    else:
+        await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
+    metric_observe('pre_checkout_seconds', time.monotonic() - started)
 
 @dp.message_handler(content_types=types.ContentType.SUCCESSFUL_PAYMENT)
 async def process_successful_payment(message: types.Message):
     # Обрабатываем успешный платеж
     payload = message.successful_payment.invoice_payload
-    user_id = int(payload.split('_')[1])
-    amount = float(payload.split('_')[2])
+    charge_id = message.successful_payment.telegram_payment_charge_id
+    
+    # Зачисляем средства на баланс (повторная доставка того же платежа ничего не делает)
+    if payload.startswith('topup_'):
+        user_id = int(payload.split('_')[1])
+        amount = float(payload.split('_')[2])
+        credited = await credit_payment(charge_id, user_id, amount, payload)
+    else:
+        credited = await credit_invoice(charge_id, payload)
+        if credited is None:
+            metric_inc('unknown_invoice_payments')
+            logger.error("Оплачен неизвестный счет %s (платеж %s)", payload, charge_id)
+            return
+        if credited:
+            user_id, amount = credited
     
-    # Зачисляем средства на баланс
-    update_balance(user_id, amount)
+    if not credited:
+        metric_inc('duplicate_payments')
+        logger.warning("Платеж %s уже был зачислен", charge_id)
+        return
+    user = await get_user(user_id)
     
     await bot.send_message(user_id,
                           f"""✅ Баланс успешно пополнен на {amount}₽!
-Текущий баланс: {get_user(user_id)[2]}₽""")
+Текущий баланс: {user[2]}₽""")
 
 @dp.callback_query_handler(lambda c: c.data == 'withdraw')
 async def withdraw_funds(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id)
     
     if user[2] <= 0:
-        await bot.answer_callback_query(callback_query.id, "На вашем балансе нет средств для вывода!")
+        await answer_callback(callback_query, "На вашем балансе нет средств для вывода!")
         return
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text=f"💰 Введите сумму для вывода (доступно: {user[2]}₽):")
     
@@ -742,7 +3279,7 @@ async def withdraw_funds(callback_query: types.CallbackQuery):
     state = Dispatcher.get_current().current_state()
     await state.update_data(current_balance=user[2])
     
-    await bot.answer_callback_query(callback_query.id)
+    await answer_callback(callback_query)
 
 @dp.message_handler(state=Form.withdraw_amount)
 async def process_withdraw_amount(message: types.Message, state: FSMContext):
@@ -763,50 +3300,354 @@ async def process_withdraw_amount(message: types.Message, state: FSMContext):
     
     user_id = message.from_user.id
     
-    # Списываем средства с баланса
-    update_balance(user_id, -amount)
+    # Списываем средства с баланса и создаем запрос на вывод
+    withdrawal_id = await request_withdrawal(user_id, amount)
+    if not withdrawal_id:
+        await message.reply("Недостаточно средств на балансе!")
+        await state.finish()
+        return
     
-    # Уведомляем администратора о запросе на вывод
-    await bot.send_message(ADMIN_ID,
-                         f"""⚠️ ЗАПРОС НА ВЫВОД СРЕДСТВ
-Пользователь: @{message.from_user.username} (ID: {user_id})
-Сумма: {amount}₽
-Реквизиты: (пользователь должен предоставить)""")
+    await state.update_data(withdrawal_id=withdrawal_id)
+    await Form.withdraw_details.set()
     
-    await message.reply(f"""✅ Запрос на вывод {amount}₽ отправлен администратору. 
+    await message.reply(f"""✅ Запрос на вывод {amount}₽ создан (№{withdrawal_id}). 
 
 Отправьте реквизиты для вывода (номер карты или другие платежные данные) ответным сообщением, и администратор обработает ваш запрос в ближайшее время.""")
+
+@dp.message_handler(state=Form.withdraw_details)
+async def process_withdraw_details(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    await set_withdrawal_details(data['withdrawal_id'], message.from_user.id, message.text)
     
+    await message.reply("Реквизиты сохранены. Администратор обработает ваш запрос в ближайшее время.")
     await state.finish()
 
+WITHDRAWALS_PAGE_SIZE = 10
+
+async def render_withdrawal_queue(after_id):
+    (count, total), rows = await get_withdrawal_queue(after_id, WITHDRAWALS_PAGE_SIZE)
+    if not rows:
+        return "Нет необработанных запросов на вывод.", None
+    
+    lines = [f"💸 Запросы на вывод: {count} на сумму {round(total, 2)}₽\n"]
+    for withdrawal_id, user_id, username, amount, details, created_at in rows:
+        lines.append(f"№{withdrawal_id} @{username} (ID: {user_id}) - {amount}₽\n"
+                     f"   {details or 'реквизиты не указаны'} ({created_at})")
+    
+    first_id, last_id = rows[0][0], rows[-1][0]
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("✅ Одобрить страницу", callback_data=f"wd_approve_{first_id}_{last_id}"),
+                 InlineKeyboardButton("❌ Отклонить страницу", callback_data=f"wd_reject_{first_id}_{last_id}"))
+    navigation = []
+    if after_id:
+        navigation.append(InlineKeyboardButton("⏮ В начало", callback_data="wd_page_0"))
+    if len(rows) == WITHDRAWALS_PAGE_SIZE:
+        navigation.append(InlineKeyboardButton("Дальше ▶️", callback_data=f"wd_page_{last_id}"))
+    if navigation:
+        keyboard.add(*navigation)
+    return "\n".join(lines), keyboard
+
+DISPUTES_PAGE_SIZE = 10
+
+def format_age(seconds):
+    if seconds < 3600:
+        return f"{int(seconds // 60)} мин"
+    if seconds < 86400:
+        return f"{int(seconds // 3600)} ч"
+    return f"{int(seconds // 86400)} д"
+
+async def render_dispute_queue(after_rowid, assigned_to=None):
+    load, rows = await get_open_disputes(after_rowid, DISPUTES_PAGE_SIZE, assigned_to)
+    scope = "mine" if assigned_to else "all"
+    
+    lines = [f"⚠️ Открытые диспуты: {sum(count for _, count in load)}"]
+    lines.append("Нагрузка: " + ", ".join(f"{admin_id}: {count}" for admin_id, count in load) if load else "")
+    if METRICS['dispute_resolution_seconds_count']:
+        average = METRICS['dispute_resolution_seconds_sum'] / METRICS['dispute_resolution_seconds_count']
+        lines.append(f"Среднее время решения: {format_age(average)}")
+    
+    keyboard = InlineKeyboardMarkup()
+    now = time.time()
+    for rowid, deal_id, opened_at, admin_id, amount in rows:
+        age = format_age(now - parse_db_timestamp(opened_at))
+        keyboard.add(InlineKeyboardButton(f"#{deal_id[:8]} - {amount}₽, {age} (адм. {admin_id})",
+                                          callback_data=f"dq_view_{deal_id}"))
+    if not rows:
+        lines.append("\nНет открытых диспутов.")
+    else:
+        lines.append("\nЗакрыть несколько сразу: /resolve refund|pay <id> ...")
+    
+    navigation = []
+    if after_rowid:
+        navigation.append(InlineKeyboardButton("⏮ В начало", callback_data=f"dq_page_{scope}_0"))
+    if len(rows) == DISPUTES_PAGE_SIZE:
+        navigation.append(InlineKeyboardButton("Дальше ▶️", callback_data=f"dq_page_{scope}_{rows[-1][0]}"))
+    if navigation:
+        keyboard.add(*navigation)
+    keyboard.add(InlineKeyboardButton("👤 Только мои" if scope == "all" else "👥 Все",
+                                      callback_data=f"dq_page_{'mine' if scope == 'all' else 'all'}_0"))
+    return "\n".join(line for line in lines if line), keyboard
+
+@dp.message_handler(commands=['disputes'])
+async def show_disputes(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    assigned_to = message.from_user.id if message.get_args().strip() == 'mine' else None
+    text, keyboard = await render_dispute_queue(0, assigned_to)
+    await message.reply(text, reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data.startswith('dq_page_'))
+async def page_disputes(callback_query: types.CallbackQuery):
+    if not is_admin(callback_query.from_user.id):
+        await answer_callback(callback_query, "Только администратор может выполнить это действие!")
+        return
+    
+    scope, after_rowid = callback_query.data.replace('dq_page_', '').split('_')
+    assigned_to = callback_query.from_user.id if scope == 'mine' else None
+    text, keyboard = await render_dispute_queue(int(after_rowid), assigned_to)
+    await edit_message_text(chat_id=callback_query.message.chat.id,
+                              message_id=callback_query.message.message_id,
+                              text=text,
+                              reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data.startswith('dq_view_'))
+async def view_queued_dispute(callback_query: types.CallbackQuery):
+    if not is_admin(callback_query.from_user.id):
+        await answer_callback(callback_query, "Только администратор может выполнить это действие!")
+        return
+    
+    deal_id = callback_query.data.replace('dq_view_', '')
+    deal = await get_deal(deal_id)
+    dispute = await get_dispute(deal_id)
+    if not deal or not dispute:
+        await answer_callback(callback_query, "Диспут не найден!")
+        return
+    
+    product = await get_product(deal[3])
+    buyer = await get_user(deal[1])
+    seller = await get_user(deal[2])
+    
+    await bot.send_message(callback_query.from_user.id,
+                         f"""⚠️ Диспут по сделке #{deal_id}
+Товар: {product[2]}
+Покупатель: @{buyer[1]} (ID: {buyer[0]})
+Продавец: @{seller[1]} (ID: {seller[0]})
+Сумма: {deal[4]}₽
+Открыт: {dispute[2]}, ответственный: {dispute[3]}
+
+Выберите действие:""",
+                         reply_markup=dispute_actions_keyboard(deal_id))
+    await answer_callback(callback_query)
+
+RESOLVE_MAX_DEALS = 200
+
+@dp.message_handler(commands=['resolve'])
+async def resolve_disputes(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    args = message.get_args().replace(',', ' ').split()
+    if len(args) < 2 or args[0] not in ('refund', 'pay'):
+        await message.reply("""Использование: /resolve <refund|pay> <id сделки> [id сделки ...]
+
+refund - вернуть деньги покупателям, pay - передать деньги продавцам.
+Закрываются только сделки в диспуте. Можно указывать начало id (не короче 8 символов), как в /disputes.""")
+        return
+    
+    outcome = args[0]
+    deal_refs = list(dict.fromkeys(args[1:]))
+    if any(len(deal_ref) < 8 for deal_ref in deal_refs):
+        await message.reply("Укажите не меньше 8 первых символов id каждой сделки.")
+        return
+    if len(deal_refs) > RESOLVE_MAX_DEALS:
+        await message.reply(f"За один раз можно закрыть не больше {RESOLVE_MAX_DEALS} сделок.")
+        return
+    
+    resolved, skipped = await resolve_deals(deal_refs, outcome)
+    
+    action = "Деньги возвращены покупателям" if outcome == 'refund' else "Деньги переданы продавцам"
+    text = f"✅ {action}: {len(resolved)} сделок на {round(sum(amount for _, amount in resolved), 2)}₽"
+    if skipped:
+        text += "\n\n⚠️ Пропущены (не найдены, не в диспуте или id неоднозначен):\n" + "\n".join(skipped)
+    await message.reply(text)
+
+@dp.message_handler(commands=['withdrawals'])
+async def show_withdrawals(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    text, keyboard = await render_withdrawal_queue(0)
+    await message.reply(text, reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data.startswith('wd_page_'))
+async def page_withdrawals(callback_query: types.CallbackQuery):
+    if not is_admin(callback_query.from_user.id):
+        await answer_callback(callback_query, "Только администратор может выполнить это действие!")
+        return
+    
+    text, keyboard = await render_withdrawal_queue(int(callback_query.data.replace('wd_page_', '')))
+    await edit_message_text(chat_id=callback_query.message.chat.id,
+                              message_id=callback_query.message.message_id,
+                              text=text,
+                              reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data.startswith(('wd_approve_', 'wd_reject_')))
+async def decide_withdrawal_page(callback_query: types.CallbackQuery):
+    if not is_admin(callback_query.from_user.id):
+        await answer_callback(callback_query, "Только администратор может выполнить это действие!")
+        return
+    
+    action, first_id, last_id = callback_query.data.rsplit('_', 2)
+    approve = action == 'wd_approve'
+    batch_id, count, total = await decide_withdrawals(int(first_id), int(last_id), approve)
+    if not count:
+        await answer_callback(callback_query, "Эти запросы уже обработаны!", show_alert=True)
+        return
+    
+    keyboard = InlineKeyboardMarkup()
+    if approve:
+        keyboard.add(InlineKeyboardButton("📄 Выгрузить CSV", callback_data=f"wd_csv_{batch_id}"))
+        keyboard.add(InlineKeyboardButton("💸 Отметить выплаченными", callback_data=f"wd_paid_{batch_id}"))
+        text = f"✅ Одобрено запросов: {count} на сумму {round(total, 2)}₽ (пакет {batch_id})"
+    else:
+        text = f"❌ Отклонено запросов: {count}, {round(total, 2)}₽ возвращено на балансы"
+    keyboard.add(InlineKeyboardButton("💸 К очереди", callback_data="wd_page_0"))
+    
+    await edit_message_text(chat_id=callback_query.message.chat.id,
+                              message_id=callback_query.message.message_id,
+                              text=text,
+                              reply_markup=keyboard)
+    await answer_callback(callback_query, "Готово!")
+
+@dp.callback_query_handler(lambda c: c.data.startswith('wd_csv_'))
+async def export_withdrawals(callback_query: types.CallbackQuery):
+    if not is_admin(callback_query.from_user.id):
+        await answer_callback(callback_query, "Только администратор может выполнить это действие!")
+        return
+    
+    batch_id = callback_query.data.replace('wd_csv_', '')
+    output = await export_withdrawal_batch(batch_id)
+    try:
+        await bot.send_document(callback_query.from_user.id,
+                                types.InputFile(output, filename=f"withdrawals_{batch_id}.csv"),
+                                caption=f"Пакет выплат {batch_id}")
+    finally:
+        output.close()
+
+@dp.callback_query_handler(lambda c: c.data.startswith('wd_paid_'))
+async def mark_withdrawals_paid(callback_query: types.CallbackQuery):
+    if not is_admin(callback_query.from_user.id):
+        await answer_callback(callback_query, "Только администратор может выполнить это действие!")
+        return
+    
+    batch_id = callback_query.data.replace('wd_paid_', '')
+    count = await mark_withdrawal_batch_paid(batch_id)
+    await answer_callback(callback_query, f"Выплачено запросов: {count}")
+
 @dp.callback_query_handler(lambda c: c.data == 'profile')
 async def show_profile(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
-    user = get_user(user_id)
+    user = await get_user(user_id)
     
     keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("📈 Статистика продаж", callback_data="seller_stats"))
     keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_main"))
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text=f"""📊 <b>Ваш профиль</b>
 
 👤 Имя пользователя: @{user[1]}
 💰 Баланс: {user[2]}₽
-⭐ Рейтинг: {user[3]}
+⭐ Рейтинг: {format_rating(user)}
 🛒 Всего сделок: {user[4]}
 📅 Дата регистрации: {user[5]}""",
                               parse_mode='HTML',
                               reply_markup=keyboard)
 
+def format_seller_stats(title, stats):
+    deals, sales, gross, commission, refunds, refunds_amount, disputes = stats or (0,) * 7
+    conversion = f"{sales / deals:.0%}" if deals else "—"
+    dispute_rate = f"{disputes / deals:.0%}" if deals else "—"
+    return f"""<b>{title}</b>
+🤝 Сделок: {int(deals)}, завершено: {int(sales)} (конверсия {conversion})
+💰 Оборот: {gross:.2f}₽, ваш доход: {gross - commission:.2f}₽
+↩️ Возвратов: {int(refunds)} на {refunds_amount:.2f}₽
+⚠️ Диспутов: {int(disputes)} ({dispute_rate})"""
+
+async def render_seller_stats(user_id):
+    total, period, today = await get_seller_stats(user_id)
+    return "📈 <b>Статистика продаж</b>\n\n" + "\n\n".join([
+        format_seller_stats("Сегодня", today),
+        format_seller_stats(f"За {SELLER_STATS_PERIOD_DAYS} дней", period),
+        format_seller_stats("За все время", total),
+    ])
+
+@dp.message_handler(commands=['stats'])
+async def show_stats(message: types.Message):
+    await message.reply(await render_seller_stats(message.from_user.id), parse_mode='HTML')
+
+@dp.callback_query_handler(lambda c: c.data == 'seller_stats')
+async def show_seller_stats(callback_query: types.CallbackQuery):
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="profile"))
+    
+    await edit_message_text(chat_id=callback_query.message.chat.id,
+                              message_id=callback_query.message.message_id,
+                              text=await render_seller_stats(callback_query.from_user.id),
+                              parse_mode='HTML',
+                              reply_markup=keyboard)
+
 @dp.callback_query_handler(lambda c: c.data == 'add_product')
 async def add_product_start(callback_query: types.CallbackQuery):
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
-                              text="✏️ Введите название товара:")
+                              text="""✏️ Введите название товара:
+
+Чтобы добавить сразу много товаров, отправьте /import и загрузите CSV или JSON файл.""")
     
     await Form.add_product_title.set()
-    await bot.answer_callback_query(callback_query.id)
+    await answer_callback(callback_query)
+
+@dp.message_handler(commands=['import'])
+async def import_products_start(message: types.Message):
+    await Form.import_products.set()
+    await message.reply("""📥 Отправьте файл с товарами:
+• CSV с колонками title, description, price, category и необязательной stock (остаток)
+• или JSON (массив объектов либо по одному объекту на строку) с теми же полями
+
+Максимум {max_rows} строк в одном файле.""".format(max_rows=IMPORT_MAX_ROWS))
+
+@dp.message_handler(content_types=types.ContentType.DOCUMENT, state=Form.import_products)
+async def process_import_file(message: types.Message, state: FSMContext):
+    document = message.document
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await message.reply("Файл слишком большой (максимум 20 МБ).")
+        return
+    
+    await state.finish()
+    await message.reply("⏳ Загружаю товары...")
+    
+    with tempfile.TemporaryFile() as file:
+        await document.download(destination_file=file)
+        file.seek(0)
+        imported, errors, duration = await import_products_file(message.from_user.id, file,
+                                                                document.file_name or 'products.csv')
+    
+    text = f"✅ Добавлено товаров: {imported} за {duration:.1f} с"
+    if errors:
+        text += f"\n\n⚠️ Строк с ошибками: {len(errors)}"
+        for row, error in errors[:IMPORT_MAX_ERRORS_SHOWN]:
+            text += f"\nСтрока {row}: {error}"
+        if len(errors) > IMPORT_MAX_ERRORS_SHOWN:
+            text += f"\n... и еще {len(errors) - IMPORT_MAX_ERRORS_SHOWN}"
+    await message.reply(text)
+
+@dp.message_handler(state=Form.import_products)
+async def process_import_text(message: types.Message, state: FSMContext):
+    await state.finish()
+    await message.reply("Загрузка товаров отменена. Чтобы начать заново, отправьте /import.")
 
 @dp.message_handler(state=Form.add_product_title)
 async def process_product_title(message: types.Message, state: FSMContext):
@@ -843,10 +3684,13 @@ async def process_product_price(message: types.Message, state: FSMContext):
 @dp.message_handler(state=Form.add_product_category)
 async def process_product_category(message: types.Message, state: FSMContext):
     category = message.text
+    if not normalize_category(category)[0]:
+        await message.reply("Пожалуйста, введите название категории.")
+        return
     data = await state.get_data()
     
     # Добавляем товар в базу данных
-    product_id = add_product(message.from_user.id, data['title'], data['description'], data['price'], category)
+    product_id = await add_product(message.from_user.id, data['title'], data['description'], data['price'], category)
     
     await message.reply(f"""✅ Товар "{data['title']}" успешно добавлен в магазин!
 
@@ -857,20 +3701,22 @@ async def process_product_category(message: types.Message, state: FSMContext):
 @dp.callback_query_handler(lambda c: c.data == 'my_products')
 async def show_my_products(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
-    products = get_user_products(user_id)
+    products = await get_user_products(user_id)
     
     if not products:
-        await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+        await edit_message_text(chat_id=callback_query.message.chat.id,
                                   message_id=callback_query.message.message_id,
                                   text="У вас пока нет активных товаров.")
         return
     
     keyboard = InlineKeyboardMarkup()
     for product in products:
-        keyboard.add(InlineKeyboardButton(f"{product[2]} - {product[4]}₽", callback_data=f"manage_product_{product[0]}"))
+        sold_out = " (распродан)" if product[11] == 0 else ""
+        keyboard.add(InlineKeyboardButton(f"{product[2]} - {product[4]}₽{sold_out}",
+                                          callback_data=f"manage_product_{product[0]}"))
     keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_main"))
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text="📦 Ваши товары:",
                               reply_markup=keyboard)
@@ -878,74 +3724,143 @@ async def show_my_products(callback_query: types.CallbackQuery):
 @dp.callback_query_handler(lambda c: c.data.startswith('manage_product_'))
 async def manage_product(callback_query: types.CallbackQuery):
     product_id = int(callback_query.data.replace('manage_product_', ''))
-    product = get_product(product_id)
+    product = await get_product(product_id)
     
     if not product or product[1] != callback_query.from_user.id:
-        await bot.answer_callback_query(callback_query.id, "Товар не найден!")
+        await answer_callback(callback_query, "Товар не найден!")
         return
     
     keyboard = InlineKeyboardMarkup()
     keyboard.add(InlineKeyboardButton("✏️ Редактировать", callback_data=f"edit_product_{product_id}"))
+    keyboard.add(InlineKeyboardButton("🔑 Загрузить ключи", callback_data=f"product_keys_{product_id}"))
+    if not product[9]:
+        keyboard.add(InlineKeyboardButton("📦 Изменить остаток", callback_data=f"product_stock_{product_id}"))
     keyboard.add(InlineKeyboardButton("❌ Удалить", callback_data=f"delete_product_{product_id}"))
     keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="my_products"))
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text=f"""📦 Управление товаром:
                               
 Название: {product[2]}
 Описание: {product[3]}
 Цена: {product[4]}₽
-Категория: {product[5]}""",
+Категория: {product[5]}
+Остаток: {"без ограничений" if product[11] is None else f"{product[11]} шт."}
+Автовыдача: {f"{product[10]} ключей в наличии" if product[9] else "выключена"}""",
                               reply_markup=keyboard)
 
+@dp.callback_query_handler(lambda c: c.data.startswith('product_stock_'))
+async def change_product_stock(callback_query: types.CallbackQuery):
+    product_id = int(callback_query.data.replace('product_stock_', ''))
+    product = await get_product(product_id)
+    
+    if not product or product[1] != callback_query.from_user.id:
+        await answer_callback(callback_query, "Товар не найден!")
+        return
+    
+    await edit_message_text(chat_id=callback_query.message.chat.id,
+                              message_id=callback_query.message.message_id,
+                              text=f"""📦 Введите остаток для товара "{product[2]}" (целое число) или "-", чтобы снять ограничение.
+
+Когда остаток закончится, товар автоматически пропадет из магазина.""")
+    
+    await Form.product_stock.set()
+    state = Dispatcher.get_current().current_state()
+    await state.update_data(product_id=product_id)
+    
+    await answer_callback(callback_query)
+
+@dp.message_handler(state=Form.product_stock)
+async def process_product_stock(message: types.Message, state: FSMContext):
+    text = message.text.strip()
+    if text == '-':
+        stock = None
+    else:
+        try:
+            stock = int(text)
+            if stock < 0:
+                raise ValueError
+        except ValueError:
+            await message.reply("Пожалуйста, введите целое число не меньше нуля или \"-\".")
+            return
+    
+    data = await state.get_data()
+    await state.finish()
+    await set_product_stock(data['product_id'], stock)
+    await message.reply("✅ Остаток обновлен: " + ("без ограничений" if stock is None else f"{stock} шт."))
+
+@dp.callback_query_handler(lambda c: c.data.startswith('product_keys_'))
+async def upload_product_keys(callback_query: types.CallbackQuery):
+    product_id = int(callback_query.data.replace('product_keys_', ''))
+    product = await get_product(product_id)
+    
+    if not product or product[1] != callback_query.from_user.id:
+        await answer_callback(callback_query, "Товар не найден!")
+        return
+    
+    await edit_message_text(chat_id=callback_query.message.chat.id,
+                              message_id=callback_query.message.message_id,
+                              text=f"""🔑 Отправьте ключи для товара "{product[2]}" - по одному на строку, сообщением или .txt файлом.
+
+После загрузки ключей покупатели будут получать их сразу после оплаты.""")
+    
+    await Form.add_product_keys.set()
+    state = Dispatcher.get_current().current_state()
+    await state.update_data(product_id=product_id)
+    
+    await answer_callback(callback_query)
+
+@dp.message_handler(content_types=[types.ContentType.TEXT, types.ContentType.DOCUMENT], state=Form.add_product_keys)
+async def process_product_keys(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    await state.finish()
+    
+    if message.document:
+        if message.document.file_size and message.document.file_size > IMPORT_MAX_FILE_SIZE:
+            await message.reply("Файл слишком большой (максимум 20 МБ).")
+            return
+        content = io.BytesIO()
+        await message.document.download(destination_file=content)
+        text = content.getvalue().decode('utf-8-sig', errors='replace')
+    else:
+        text = message.text
+    
+    keys = [line.strip() for line in text.splitlines() if line.strip()]
+    if not keys:
+        await message.reply("Ключи не найдены. Загрузка отменена.")
+        return
+    
+    available = await add_product_keys(data['product_id'], keys)
+    await message.reply(f"✅ Загружено ключей: {len(keys)}. Всего в наличии: {available}.")
+
 @dp.callback_query_handler(lambda c: c.data.startswith('delete_product_'))
 async def delete_product(callback_query: types.CallbackQuery):
     product_id = int(callback_query.data.replace('delete_product_', ''))
-    product = get_product(product_id)
+    product = await get_product(product_id)
     
     if not product or product[1] != callback_query.from_user.id:
-        await bot.answer_callback_query(callback_query.id, "Товар не найден!")
+        await answer_callback(callback_query, "Товар не найден!")
         return
     
     # "Удаляем" товар (делаем неактивным)
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE products SET is_active = FALSE WHERE product_id = ?', (product_id,))
-    conn.commit()
-    conn.close()
+    await deactivate_product(product_id)
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text=f"✅ Товар \"{product[2]}\" удален.")
     
-    await bot.answer_callback_query(callback_query.id, "Товар удален!")
+    await answer_callback(callback_query, "Товар удален!")
 
 @dp.callback_query_handler(lambda c: c.data == 'my_deals')
 async def show_my_deals(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
-    conn = sqlite3.connect('craazydeals.db')
-    cursor = conn.cursor()
     
     # Получаем сделки, где пользователь является покупателем или продавцом
-    cursor.execute('''
-    SELECT d.deal_id, d.status, d.amount, p.title, 
-           CASE WHEN d.buyer_id = ? THEN 'buyer' ELSE 'seller' END AS role,
-           CASE WHEN d.buyer_id = ? THEN u2.username ELSE u1.username END AS counterparty
-    FROM deals d
-    JOIN products p ON d.product_id = p.product_id
-    JOIN users u1 ON d.buyer_id = u1.user_id
-    JOIN users u2 ON d.seller_id = u2.user_id
-    WHERE d.buyer_id = ? OR d.seller_id = ?
-    ORDER BY d.created_at DESC
-    LIMIT 10
-    ''', (user_id, user_id, user_id, user_id))
-    
-    deals = cursor.fetchall()
-    conn.close()
+    deals = await get_user_deals(user_id)
     
     if not deals:
-        await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+        await edit_message_text(chat_id=callback_query.message.chat.id,
                                   message_id=callback_query.message.message_id,
                                   text="У вас пока нет сделок.")
         return
@@ -959,24 +3874,72 @@ async def show_my_deals(callback_query: types.CallbackQuery):
         ))
     keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_main"))
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text="🤝 Ваши последние сделки:",
                               reply_markup=keyboard)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('view_deal_'))
-async def view_deal(callback_query: types.CallbackQuery):
-    deal_id = callback_query.data.replace('view_deal_', '')
-    deal = get_deal(deal_id)
-    user_id = callback_query.from_user.id
-    
+# Переписка в диспуте показывается окнами: последние DISPUTE_PAGE_SIZE сообщений,
+# сколько поместится в лимит длины сообщения Telegram, с кнопками "Раньше"/"Позже"
+DISPUTE_PAGE_SIZE = 10
+MESSAGE_TEXT_LIMIT = 4096
+# Сколько места под переписку остается всегда, даже если шапка сделки очень длинная
+DISPUTE_THREAD_MIN_LENGTH = 1024
+
+def telegram_length(text):
+    # Лимит Telegram считается в UTF-16 единицах: эмодзи занимают по две
+    return len(text.encode('utf-16-le')) // 2
+
+def truncate_to_length(text, limit):
+    """Обрезает текст до limit UTF-16 единиц, помечая обрезку многоточием"""
+    if telegram_length(text) <= limit:
+        return text
+    if limit < 1:
+        return ""
+    while text and telegram_length(text) > limit - 1:
+        text = text[:len(text) - max(1, (telegram_length(text) - limit + 1) // 2)]
+    return text + "…"
+
+async def render_dispute_thread(deal_id, budget, before_id=None, after_id=None):
+    """Возвращает текст окна переписки не длиннее budget и курсоры для соседних окон (или None)"""
+    rows = await get_dispute_messages(deal_id, before_id, after_id)
+    more = len(rows) > DISPUTE_PAGE_SIZE
+    rows = rows[:DISPUTE_PAGE_SIZE]
+    
+    # Набираем сообщения начиная с ближайшего к курсору, пока хватает места
+    parts = []
+    used = 0
+    for message_id, user_id, username, message, sent_at in rows:
+        part = f"\n\n@{username} ({sent_at}):\n{message}"
+        length = telegram_length(part)
+        if used + length > budget:
+            if parts:
+                more = True
+                break
+            # Одно сообщение длиннее всего окна - обрезаем его
+            part = truncate_to_length(part, budget)
+            length = telegram_length(part)
+        parts.append((message_id, part))
+        used += length
+    
+    if not parts:
+        return "\n\nСообщений пока нет.", None, None
+    if after_id is None:
+        parts.reverse()
+    
+    # Курсоры: id самого старого и самого нового из показанных сообщений
+    older = parts[0][0] if (more if after_id is None else True) else None
+    newer = parts[-1][0] if (before_id is not None if after_id is None else more) else None
+    return "".join(part for _, part in parts), older, newer
+
+async def render_deal(deal_id, user_id, before_id=None, after_id=None):
+    deal = await get_deal(deal_id, include_archive=True)
     if not deal or user_id not in (deal[1], deal[2]):
-        await bot.answer_callback_query(callback_query.id, "Сделка не найдена!")
-        return
+        return None, None
     
-    product = get_product(deal[3])
-    buyer = get_user(deal[1])
-    seller = get_user(deal[2])
+    product = await get_product(deal[3])
+    buyer = await get_user(deal[1])
+    seller = await get_user(deal[2])
     
     status_text = {
         'pending': "Ожидает отправки",
@@ -1006,18 +3969,59 @@ async def view_deal(callback_query: types.CallbackQuery):
     if deal[5] in ('pending', 'sent') and user_id in (deal[1], deal[2]):  # Участники могут открыть диспут
         keyboard.add(InlineKeyboardButton("⚠️ Открыть диспут", callback_data=f"dispute_{deal_id}"))
     
+    if deal[5] == 'completed' and user_id == deal[1] and not await has_review(deal_id):
+        text += "\n\n⭐ Оцените продавца:"
+        keyboard.row(*review_keyboard(deal_id).inline_keyboard[0])
+    
     if deal[5] == 'dispute':
-        # Показать историю сообщений в диспуте
-        messages = get_dispute_messages(deal_id)
-        for msg in messages:
-            text += f"\n\n@{msg[2]}: {msg[3]}"
+        # Показать историю сообщений в диспуте; шапку укорачиваем, чтобы переписке всегда хватило места
+        text = truncate_to_length(text, MESSAGE_TEXT_LIMIT - DISPUTE_THREAD_MIN_LENGTH)
+        text += "\n\n💬 Переписка:"
+        thread, older, newer = await render_dispute_thread(
+            deal_id, MESSAGE_TEXT_LIMIT - telegram_length(text), before_id, after_id)
+        text += thread
+        
+        navigation = []
+        if older:
+            navigation.append(InlineKeyboardButton("◀️ Раньше", callback_data=f"dthread_o_{older}_{deal_id}"))
+        if newer:
+            navigation.append(InlineKeyboardButton("Позже ▶️", callback_data=f"dthread_n_{newer}_{deal_id}"))
+        if navigation:
+            keyboard.row(*navigation)
         
         if user_id in (deal[1], deal[2]):
             keyboard.add(InlineKeyboardButton("💬 Ответить в диспуте", callback_data=f"reply_dispute_{deal_id}"))
     
     keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="my_deals"))
+    return text, keyboard
+
+@dp.callback_query_handler(lambda c: c.data.startswith('view_deal_'))
+async def view_deal(callback_query: types.CallbackQuery):
+    deal_id = callback_query.data.replace('view_deal_', '')
+    text, keyboard = await render_deal(deal_id, callback_query.from_user.id)
+    
+    if text is None:
+        await answer_callback(callback_query, "Сделка не найдена!")
+        return
+    
+    await edit_message_text(chat_id=callback_query.message.chat.id,
+                              message_id=callback_query.message.message_id,
+                              text=text,
+                              reply_markup=keyboard)
+
+@dp.callback_query_handler(lambda c: c.data.startswith('dthread_'))
+async def page_dispute_thread(callback_query: types.CallbackQuery):
+    direction, message_id, deal_id = callback_query.data.replace('dthread_', '').split('_', 2)
+    if direction == 'o':
+        text, keyboard = await render_deal(deal_id, callback_query.from_user.id, before_id=int(message_id))
+    else:
+        text, keyboard = await render_deal(deal_id, callback_query.from_user.id, after_id=int(message_id))
+    
+    if text is None:
+        await answer_callback(callback_query, "Сделка не найдена!")
+        return
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text=text,
                               reply_markup=keyboard)
@@ -1025,14 +4029,14 @@ async def view_deal(callback_query: types.CallbackQuery):
 @dp.callback_query_handler(lambda c: c.data.startswith('reply_dispute_'))
 async def reply_to_dispute(callback_query: types.CallbackQuery):
     deal_id = callback_query.data.replace('reply_dispute_', '')
-    deal = get_deal(deal_id)
+    deal = await get_deal(deal_id)
     user_id = callback_query.from_user.id
     
     if not deal or user_id not in (deal[1], deal[2]):
-        await bot.answer_callback_query(callback_query.id, "Сделка не найдена!")
+        await answer_callback(callback_query, "Сделка не найдена!")
         return
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text="Введите ваше сообщение для диспута:")
     
@@ -1040,7 +4044,7 @@ async def reply_to_dispute(callback_query: types.CallbackQuery):
     state = Dispatcher.get_current().current_state()
     await state.update_data(deal_id=deal_id, user_id=user_id)
     
-    await bot.answer_callback_query(callback_query.id)
+    await answer_callback(callback_query)
 
 @dp.callback_query_handler(lambda c: c.data == 'back_to_main')
 async def back_to_main(callback_query: types.CallbackQuery):
@@ -1052,7 +4056,7 @@ async def back_to_main(callback_query: types.CallbackQuery):
     keyboard.add(InlineKeyboardButton("📦 Мои товары", callback_data="my_products"))
     keyboard.add(InlineKeyboardButton("🤝 Мои сделки", callback_data="my_deals"))
     
-    await bot.edit_message_text(chat_id=callback_query.message.chat.id,
+    await edit_message_text(chat_id=callback_query.message.chat.id,
                               message_id=callback_query.message.message_id,
                               text="""👋 Добро пожаловать в CraazyDeals - безопасную площадку для покупки и продажи цифровых товаров!
 
@@ -1062,6 +4066,125 @@ async def back_to_main(callback_query: types.CallbackQuery):
 Выберите действие:""",
                               reply_markup=keyboard)
 
+@dp.message_handler(commands=['metrics'])
+async def show_metrics(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    lines = [f"{name}: {round(value, 4)}" for name, value in sorted(METRICS.items())]
+    await message.reply("📈 Метрики:\n" + ("\n".join(lines) if lines else "пока пусто"))
+
+@dp.message_handler(commands=['backup'])
+async def make_backup(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    try:
+        paths = await run_backup()
+    except Exception as e:
+        metric_inc('backup_failures')
+        logger.exception("Не удалось сделать бэкап базы")
+        await message.reply(f"❌ Бэкап не удался: {e}")
+        return
+    
+    await message.reply("✅ Бэкап готов:\n" + "\n".join(paths))
+
+@dp.message_handler(commands=['check_ratings'])
+async def check_ratings_command(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    fix = message.get_args().strip() == 'fix'
+    mismatches = await check_ratings(fix)
+    if not mismatches:
+        await message.reply("✅ Рейтинги всех продавцов совпадают с отзывами.")
+        return
+    
+    lines = [f"ID {user_id}: {count} отз. на {total}, в профиле {stored_count} на {stored_sum}"
+             for user_id, stored_sum, stored_count, total, count in mismatches[:20]]
+    await message.reply(f"⚠️ Расхождений: {len(mismatches)}" + (" (исправлены)" if fix else " (/check_ratings fix)") +
+                        "\n" + "\n".join(lines))
+
+@dp.message_handler(commands=['maintenance'])
+async def make_maintenance(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    try:
+        report = await run_maintenance()
+    except Exception as e:
+        metric_inc('maintenance_failures')
+        logger.exception("Не удалось выполнить обслуживание базы")
+        await message.reply(f"❌ Обслуживание не удалось: {e}")
+        return
+    
+    await message.reply(f"""✅ Обслуживание базы выполнено за {report['seconds']} с
+Освобождено: {report['reclaimed_bytes'] // 1024} КБ (свободных страниц осталось: {report['free_pages_left']})
+WAL уменьшен на {report['wal_bytes_truncated'] // 1024} КБ (не перенесено кадров: {report['wal_frames_left']})
+Удалено старых update_id: {report['processed_updates_pruned']}""")
+
+@dp.message_handler(commands=['export'])
+async def export_data(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    
+    args = message.get_args().split()
+    if not args or args[0] not in EXPORTS:
+        await message.reply("""Использование: /export <deals|ledger|balances> [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [статус]
+
+Статус: для deals - статус сделки, для ledger - тип операции (topup, purchase, refund, sale, commission, withdrawal, withdrawal_rejected), для balances - active или banned.
+Пример: /export deals 2024-01-01 2024-01-31 completed""")
+        return
+    
+    kind = args[0]
+    dates = []
+    status = None
+    for arg in args[1:]:
+        try:
+            dates.append(datetime.date.fromisoformat(arg).isoformat())
+        except ValueError:
+            status = arg
+    if len(dates) > 2:
+        await message.reply("Укажите не больше двух дат: начало и конец периода.")
+        return
+    date_from = dates[0] if dates else None
+    date_to = dates[1] if len(dates) > 1 else None
+    
+    await message.reply("⏳ Готовлю выгрузку...")
+    output = await export_report(kind, date_from, date_to, status)
+    try:
+        filename = f"{kind}_{datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.csv.gz"
+        caption = f"Выгрузка {kind}"
+        if date_from:
+            caption += f" с {date_from}"
+        if date_to:
+            caption += f" по {date_to}"
+        if status:
+            caption += f", {status}"
+        await bot.send_document(message.chat.id, types.InputFile(output, filename=filename), caption=caption)
+    finally:
+        output.close()
+
+# Фоновые задачи
+background_tasks = []
+
+async def on_startup(dispatcher):
+    await recent_updates.load()
+    background_tasks.append(asyncio.create_task(run_outbox_dispatcher()))
+    background_tasks.append(asyncio.create_task(deal_timeouts.run()))
+    background_tasks.append(asyncio.create_task(run_archiver()))
+    background_tasks.append(asyncio.create_task(run_backup_scheduler()))
+    background_tasks.append(asyncio.create_task(run_invoice_reconciler()))
+    background_tasks.append(asyncio.create_task(run_maintenance_scheduler()))
+
+async def on_shutdown(dispatcher):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await dispatcher.update_scheduler.close()
+    await db_writer.close()
+    db_reader.close()
+
 # Запуск бота
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
\ No newline at end of file
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file